@@ -6,12 +6,25 @@ author: Geoffroy de Gournay
 date: August 2022
 """
 
-from flask import Flask, request, jsonify
-import pandas as pd
-from diagnostics import model_predictions, dataframe_summary, missing_data, execution_time, outdated_packages_list
-from scoring import score_model
 import json
-import os
+import time
+import itertools
+
+from flask import Flask, Response, request, jsonify, stream_with_context, g
+from batching import MicroBatcher
+from datastore import data_version
+from diagnostics import model_predict_proba, stream_predictions, dataframe_summary, id_column
+from drift import observe_predictions, drift_report, INGESTION, PREDICTIONS
+from features import SchemaError
+from jobs import JobQueue, DONE, FAILED
+from model_registry import get_registry
+from monitoring import histogram, render, size_buckets
+from prediction_io import read_request_data, read_request_chunks, read_request_records, wants_ndjson, PayloadError
+from prediction_io import NDJSON_MIMETYPE
+from prediction_io import predictions_to_json, predictions_to_ndjson
+from response_cache import cached_response
+from scoring import score_model
+from settings import get_config, test_data_path, prod_model_path, dataset_csv_path
 import logging
 
 logger = logging.getLogger(__name__)
@@ -19,58 +32,218 @@ logger = logging.getLogger(__name__)
 app = Flask(__name__)
 app.secret_key = '1652d576-484a-49fd-913a-6879acfa6ba4'
 
-with open('config.json', 'r') as f:
-    config = json.load(f)
+# background jobs for the slow endpoints
+job_queue = JobQueue()
+
+request_duration = histogram('api_request_duration_seconds',
+                             'Duration of the API requests, until the headers of the response are sent',
+                             ('endpoint', 'method', 'status'))
+prediction_rows = histogram('api_prediction_rows', 'Number of records of the prediction requests', ('stream',),
+                            buckets=size_buckets)
+
+
+@app.before_request
+def start_timer():
+    g.starttime = time.perf_counter()
+
+
+@app.after_request
+def observe_request(response):
+    if 'starttime' in g:
+        endpoint = request.url_rule.rule if request.url_rule is not None else 'unknown'
+        request_duration.observe(time.perf_counter() - g.starttime, endpoint=endpoint, method=request.method,
+                                 status=response.status_code)
+    return response
 
-dataset_csv_path = os.path.join(config['output_folder_path'])
-test_data_path = os.path.join(config['test_data_path'], 'testdata.csv')
-prod_deployment_path = os.path.join(config['prod_deployment_path'])
+
+# errors of the data sent for prediction, returned as 400 responses
+request_errors = (PayloadError, SchemaError)
+
+
+def predict_and_observe(df):
+    y_pred, y_proba = model_predict_proba(df)
+    observe_predictions(df, y_proba)
+    return y_pred, y_proba
+
+
+# small prediction requests are predicted together when micro-batching is enabled
+batcher = MicroBatcher(predict_and_observe) if get_config()['micro_batching'] else None
 
 
 @app.route("/prediction", methods=['POST', 'OPTIONS'])
 def predict():
     """
-    Load the data saved in 'datapath' and calculate related model predictions
+    Calculate model predictions on the records sent in the body of the request: a JSON array of records, a columnar
+    JSON object, a CSV stream (Content-Type: text/csv), or {'datapath': path} to read a csv file saved on the server.
     :return:
-    string with list of predictions related to data saved in 'datapath'.
+    JSON with the predicted classes and the probabilities of exiting, or newline delimited JSON (one line per record)
+    if the client accepts application/x-ndjson or asks for ?format=ndjson.
+    With ?stream=true, data is read and predicted by chunks of ?chunksize rows and the newline delimited JSON
+    response is sent chunk by chunk, so that memory usage doesn't depend on the size of the data. If a chunk after the
+    first one is invalid, the response ends with a line {"error": ..., "n_records": number of records predicted}.
+    If micro_batching is enabled in config.json, small JSON arrays of records are predicted together with the other
+    requests received at the same time (see batching.py).
     """
     logger.info('running predict')
-    data_path = request.get_json()['datapath']
+    if request.args.get('stream', 'false').lower() == 'true':
+        return predict_stream()
+
+    records = read_request_records(request, batcher.max_batch) if batcher is not None else None
+    try:
+        if records is not None:
+            df, y_pred, y_proba = batcher.predict(records)
+        else:
+            df = read_request_data(request)
+            y_pred, y_proba = predict_and_observe(df)
+    except request_errors as err:
+        return jsonify({'error': str(err)}), 400
+    prediction_rows.observe(len(df), stream='false')
 
-    df = pd.read_csv(data_path)
-    y_pred = model_predictions(df)
-    return str(y_pred)
+    if wants_ndjson(request):
+        return Response(predictions_to_ndjson(df, y_pred, y_proba, id_column), mimetype=NDJSON_MIMETYPE)
+    return Response(predictions_to_json(df, y_pred, y_proba, id_column), mimetype='application/json')
+
+
+def predict_stream():
+    """
+    Chunked prediction: read, predict and send back the data one chunk at a time
+    :return:
+    streamed newline delimited JSON response
+    """
+    chunksize = request.args.get('chunksize', get_config()['prediction_chunksize'], type=int)
+    try:
+        predictions = stream_predictions(read_request_chunks(request, chunksize))
+        # the first chunk is predicted before the response starts, so that invalid data gets a 400 response
+        first = next(predictions, None)
+    except request_errors as err:
+        return jsonify({'error': str(err)}), 400
+    if first is None:
+        return jsonify({'error': 'no record to predict'}), 400
+
+    def generate():
+        n_rows = 0
+        try:
+            for chunk, y_pred, y_proba in itertools.chain([first], predictions):
+                observe_predictions(chunk, y_proba)
+                n_rows += len(chunk)
+                yield ''.join(predictions_to_ndjson(chunk, y_pred, y_proba, id_column))
+        except request_errors as err:
+            # the response has already started: the error is sent as the last line
+            logger.info(f'prediction stream stopped after {n_rows} rows: {err}')
+            yield json.dumps({'error': str(err), 'n_records': n_rows}) + '\n'
+        prediction_rows.observe(n_rows, stream='true')
+
+    return Response(stream_with_context(generate()), mimetype=NDJSON_MIMETYPE)
+
+
+def scoring_version():
+    # version of the deployed model (the registry reloads it if it changed) and of the test data
+    return f'{get_registry().get_versioned_model()[1]}|{data_version(test_data_path())}'
+
+
+def summary_version():
+    return str(data_version(dataset_csv_path()))
 
 
 @app.route("/scoring", methods=['GET', 'OPTIONS'])
+@cached_response(scoring_version, mimetype='text/html')
 def stats1():
     """
-    Check the f1 score of the deployed model on test data.
+    Check the f1 score of the deployed model on test data. The response is cached until a new model is deployed or
+    the test data changes, with an ETag (see response_cache.py).
     :return:
     f1 score (str)
     """
     logger.info('running stats1')
-    model_path = os.path.join(prod_deployment_path, 'trainedmodel.pkl')
-    score = score_model(test_data_path, model_path)
+    score = score_model(test_data_path(), prod_model_path())
     return str(score)
 
 
 @app.route("/summarystats", methods=['GET', 'OPTIONS'])
+@cached_response(summary_version)
 def stats2():
     """
-    check means, medians, and modes for each column
+    check means, medians, and modes for each column. The response is cached until new data is ingested, with an ETag
+    (see response_cache.py).
     :return:
     json dictionary of all calculated summary statistics
     """
     logger.info('running stats2')
     col_stats = dataframe_summary()
-    return jsonify(col_stats)
+    return json.dumps(col_stats)
+
+
+@app.route("/drift", methods=['GET', 'OPTIONS'])
+def drift():
+    """
+    Drift of the data since the deployment of the model: distance between the distribution of the training data and
+    the distribution of the prediction traffic (features and scores) and of the ingested rows (features).
+    :return:
+    json of:
+    dictionary: {
+    'predictions': drift of the prediction traffic,
+    'ingestion': drift of the ingested rows
+    }
+    each with the number of rows counted, the largest PSI, whether drift is found (PSI reaching drift_psi_threshold on
+    at least drift_min_rows rows), and the PSI and KS statistic of each column (see drift.py). Status 404 if the
+    deployed model has no drift reference.
+    """
+    predictions = drift_report(PREDICTIONS)
+    if predictions is None:
+        return jsonify({'error': 'the deployed model has no drift reference'}), 404
+    return jsonify({'predictions': predictions, 'ingestion': drift_report(INGESTION)})
+
+
+@app.route("/metrics", methods=['GET'])
+def metrics():
+    """
+    Metrics of every process of the API and of the pipeline (see monitoring.py): duration of the requests of each
+    endpoint, number of records per prediction request, duration of the loads and predictions of the model, duration
+    of the stages of the pipeline, and bytes of csv files read and written.
+    :return:
+    metrics in the Prometheus text exposition format
+    """
+    return Response(render(), mimetype='text/plain; version=0.0.4')
 
 
 @app.route("/diagnostics", methods=['GET', 'OPTIONS'])
 def stats3():
     """
-    check timing and percent NA values, and dependencies
+    check timing and percent NA values, and dependencies. The diagnostics take time, so they are run as a
+    background job, in a separate process: the response is sent right away with the id of the job, the urls to poll
+    its status and get its result, and the result of the last completed diagnostics if any. A new job is only queued if
+    the last diagnostics are older than diagnostics_max_age_seconds in config.json, otherwise the last job is returned.
+    :return:
+    json (status 202 if a job is queued or running, 200 if the last diagnostics are recent) of:
+    dictionary: {
+    'job_id': id of the job,
+    'status': status of the job,
+    'status_url': url giving the status of the job,
+    'result_url': url giving the result of the job when it is done,
+    'last_result': result of the last completed diagnostics (see /diagnostics/latest) or None
+    }
+    """
+    logger.info('running stats3')
+    age = job_queue.latest_age('diagnostics')
+    latest = job_queue.latest('diagnostics')
+    if age is not None and age < get_config()['diagnostics_max_age_seconds']:
+        job = latest
+    else:
+        job = job_queue.submit('diagnostics', 'diagnostics:run_diagnostics')
+    response = {
+        'job_id': job['job_id'],
+        'status': job['status'],
+        'status_url': f"/jobs/{job['job_id']}",
+        'result_url': f"/jobs/{job['job_id']}/result",
+        'last_result': latest['result'] if latest else None,
+    }
+    return jsonify(response), 200 if job['status'] == DONE else 202
+
+
+@app.route("/diagnostics/latest", methods=['GET', 'OPTIONS'])
+def latest_diagnostics():
+    """
+    Result of the last completed diagnostics, without running them again
     :return:
     json of:
     dictionary: {
@@ -79,12 +252,43 @@ def stats3():
     'outdated': list of packages with version used and latest available version
     }
     """
-    logger.info('running stats3')
-    missing = missing_data()
-    time_check = execution_time()
-    outdated = outdated_packages_list()
-    diags = {'missing': missing, 'time_check': time_check, 'outdated': outdated}
-    return jsonify(diags)
+    latest = job_queue.latest('diagnostics')
+    if latest is None:
+        return jsonify({'error': 'no diagnostics have completed yet'}), 404
+    return jsonify(latest['result'])
+
+
+@app.route("/jobs/<job_id>", methods=['GET', 'OPTIONS'])
+def job_status(job_id):
+    """
+    Status of a background job
+    :param job_id: id of the job
+    :return:
+    json of the job record: id, kind, status (queued, running, done or failed), timestamps and error if any
+    """
+    job = job_queue.get_job(job_id)
+    if job is None:
+        return jsonify({'error': f'unknown job {job_id}'}), 404
+    return jsonify(job)
+
+
+@app.route("/jobs/<job_id>/result", methods=['GET', 'OPTIONS'])
+def job_result(job_id):
+    """
+    Result of a background job
+    :param job_id: id of the job
+    :return:
+    json of the result if the job is done, the job record with status 202 if it is still queued or running, or
+    with status 500 if it failed
+    """
+    job = job_queue.get_job(job_id)
+    if job is None:
+        return jsonify({'error': f'unknown job {job_id}'}), 404
+    if job['status'] == DONE:
+        return jsonify(job_queue.get_result(job_id))
+    if job['status'] == FAILED:
+        return jsonify(job), 500
+    return jsonify(job), 202
 
 
 if __name__ == "__main__":
@@ -0,0 +1,116 @@
+"""
+Micro-batching of prediction requests: small requests arriving at the same time are predicted together.
+
+Each request puts its records in a queue and waits. A dispatcher thread takes the first waiting request, then keeps
+collecting requests for at most micro_batch_window_ms milliseconds or until micro_batch_max_size records are
+collected, builds a single dataframe for all of them, predicts it in one vectorized call, and gives each request its
+own slice of the result. Most of the cost of a small request (building a dataframe, validating the input of the
+model) is then paid once per batch instead of once per request.
+
+Requests are only predicted together if their records have the same columns, so that a request gets exactly the
+same result as if it were predicted alone. If a batch fails, its requests are predicted one by one, so that an invalid
+request doesn't make the others fail.
+
+author: Geoffroy de Gournay
+date: August 2022
+"""
+import queue
+import threading
+import time
+import logging
+from concurrent.futures import Future
+
+import pandas as pd
+
+from monitoring import counter
+from settings import get_config
+
+logger = logging.getLogger(__name__)
+
+batch_counter = counter('micro_batches_total', 'Number of batches of prediction requests predicted together')
+batched_requests = counter('micro_batch_requests_total', 'Number of prediction requests predicted in a batch')
+
+
+class MicroBatcher:
+    """
+    Coalesce concurrent prediction requests into batches.
+    """
+
+    def __init__(self, predict_func, window_ms=None, max_batch=None):
+        """
+        :param predict_func: function called with a dataframe, returning a tuple of numpy arrays (predicted classes,
+        probabilities), one value per row
+        :param window_ms: maximum time in milliseconds a request waits for other requests, default to
+        micro_batch_window_ms in config.json
+        :param max_batch: maximum number of records of a batch, default to micro_batch_max_size in config.json
+        """
+        self.predict_func = predict_func
+        self.window = (window_ms or get_config()['micro_batch_window_ms']) / 1000
+        self.max_batch = max_batch or get_config()['micro_batch_max_size']
+        self._queue = queue.Queue()
+        self._thread = None
+        self._thread_lock = threading.Lock()
+
+    def predict(self, records):
+        """
+        Predict a list of records, together with the records of the other requests waiting at the same time
+        :param records: list of dictionaries, one per record
+        :return:
+        tuple (panda Dataframe of the records, predicted classes, probabilities of the positive class)
+        """
+        self._start()
+        future = Future()
+        self._queue.put((records, future))
+        return future.result()
+
+    def _start(self):
+        # the dispatcher thread is started by the first request, in the process serving it
+        if self._thread is None:
+            with self._thread_lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._loop, name='microbatch', daemon=True)
+                    self._thread.start()
+
+    def _loop(self):
+        while True:
+            batch = [self._queue.get()]
+            n_records = len(batch[0][0])
+            deadline = time.monotonic() + self.window
+            while n_records < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                batch.append(item)
+                n_records += len(item[0])
+
+            # requests are grouped by columns, in the order of their first appearance
+            groups = {}
+            for item in batch:
+                columns = tuple(dict.fromkeys(key for record in item[0] for key in record))
+                groups.setdefault(columns, []).append(item)
+            for group in groups.values():
+                self._run(group)
+
+    def _run(self, batch):
+        try:
+            data = pd.DataFrame.from_records([record for records, _ in batch for record in records])
+            predictions, probabilities = self.predict_func(data)
+        except Exception as err:
+            if len(batch) == 1:
+                batch[0][1].set_exception(err)
+                return
+            for item in batch:
+                self._run([item])
+            return
+
+        batch_counter.inc()
+        batched_requests.inc(len(batch))
+        offset = 0
+        for records, future in batch:
+            end = offset + len(records)
+            future.set_result((data.iloc[offset:end], predictions[offset:end], probabilities[offset:end]))
+            offset = end
@@ -0,0 +1,195 @@
+"""
+Benchmark of the ingestion and the training: both functions are timed in-process, against scratch output
+directories, so that the measures don't include the start-up of a python interpreter and the data and model used in
+production are never overwritten.
+
+Each function is run several times; the minimum, median and 95th percentile of the timings are reported with the
+peak memory allocated during one extra run. Every benchmark is appended to a history file, keeping the last
+max_history runs, so that regressions can be spotted across runs.
+
+The time needed to import the entry points is checked against the budgets set in import_time_budget_ms in
+config.json, each import being measured in a fresh interpreter:
+    python3 benchmark.py --imports
+
+author: Geoffroy de Gournay
+date: August 2022
+"""
+import os
+import sys
+import json
+import shutil
+import subprocess
+import tempfile
+import timeit
+import tracemalloc
+import logging
+from datetime import datetime
+
+import numpy as np
+
+from settings import get_config
+
+logger = logging.getLogger(__name__)
+
+# a median slower than regression_ratio times the median of the previous runs is reported as a regression
+regression_ratio = 1.5
+# number of benchmarks kept in the history file
+max_history = 200
+# libraries that are slow to import
+heavy_modules = ('numpy', 'pandas', 'pyarrow', 'sklearn', 'matplotlib', 'seaborn', 'flask')
+
+
+def measure(func, repeats):
+    """
+    Time a function and measure its peak memory
+    :param func: function without argument
+    :param repeats: number of timed runs
+    :return:
+    dictionary of timings in seconds (min, median, p95) and peak memory in MB
+    """
+    timings = []
+    for _ in range(repeats):
+        starttime = timeit.default_timer()
+        func()
+        timings.append(timeit.default_timer() - starttime)
+
+    # memory is traced in a separate run, as tracing slows down the function
+    tracemalloc.start()
+    try:
+        func()
+        peak_memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'min': float(np.min(timings)),
+        'median': float(np.median(timings)),
+        'p95': float(np.percentile(timings, 95)),
+        'peak_memory_mb': peak_memory / 2 ** 20,
+        'repeats': repeats,
+    }
+
+
+def run_benchmark(repeats=None, save=True):
+    """
+    Benchmark merge_multiple_dataframe and train_model in scratch directories
+    :param repeats: number of timed runs of each function, default to benchmark_repeats in config.json
+    :param save: append the result to the history file if true
+    :return:
+    dictionary {'timestamp': ..., 'ingestion': measures, 'training': measures, 'regressions': [...]}
+    """
+    # imported here so that the import time budget can be checked without loading the pipeline
+    from ingestion import merge_multiple_dataframe, output_paths
+    from training import train_model
+
+    repeats = repeats or get_config()['benchmark_repeats']
+    logger.info(f'benchmark of ingestion and training ({repeats} runs)')
+    scratch_path = tempfile.mkdtemp(prefix='benchmark_')
+    try:
+        data_path = output_paths(scratch_path)[0]
+        model_path = os.path.join(scratch_path, 'trainedmodel.pkl')
+        result = {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'ingestion': measure(lambda: merge_multiple_dataframe(scratch_path), repeats),
+            'training': measure(lambda: train_model(data_path, model_path, mode='full'), repeats),
+        }
+    finally:
+        shutil.rmtree(scratch_path, ignore_errors=True)
+
+    result['regressions'] = find_regressions(result, load_history())
+    for stage in result['regressions']:
+        logger.warning(f'benchmark: {stage} is slower than in previous runs')
+    if save:
+        save_history(result)
+    return result
+
+
+def history_path():
+    return os.path.join(get_config()['output_model_path'], 'benchmarkhistory.jsonl')
+
+
+def save_history(result):
+    """
+    Append a benchmark to the history file, keeping the last max_history benchmarks
+    """
+    path = history_path()
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    history = load_history(last=max_history - 1) + [result]
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(''.join(json.dumps(run) + '\n' for run in history))
+    os.replace(tmp_path, path)
+
+
+def load_history(last=20):
+    """
+    Load the latest benchmarks
+    :param last: maximum number of benchmarks returned
+    :return:
+    list of benchmark results, oldest first
+    """
+    try:
+        with open(history_path(), 'r') as f:
+            lines = [line for line in f.read().split('\n') if line]
+    except FileNotFoundError:
+        return []
+    return [json.loads(line) for line in lines[-last:]]
+
+
+def find_regressions(result, history):
+    """
+    Compare a benchmark with the previous ones
+    :param result: benchmark result
+    :param history: previous benchmark results
+    :return:
+    list of the stages whose median timing is more than regression_ratio times the median of the previous medians
+    """
+    regressions = []
+    for stage in ('ingestion', 'training'):
+        previous = [run[stage]['median'] for run in history if stage in run]
+        if previous and result[stage]['median'] > regression_ratio * np.median(previous):
+            regressions.append(stage)
+    return regressions
+
+
+def measure_import_time(module):
+    """
+    Measure the time needed to import a module in a fresh interpreter
+    :param module: name of the module
+    :return:
+    dictionary with the import time in ms and the heavy libraries loaded by the import
+    """
+    code = (
+        'import json, sys, time\n'
+        'start = time.perf_counter()\n'
+        f'import {module}\n'
+        'elapsed = time.perf_counter() - start\n'
+        f'print(json.dumps([elapsed, [name for name in {heavy_modules!r} if name in sys.modules]]))\n'
+    )
+    output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout
+    elapsed, loaded = json.loads(output.strip().split('\n')[-1])
+    return {'module': module, 'import_time_ms': elapsed * 1000, 'heavy_modules': loaded}
+
+
+def check_import_budget():
+    """
+    Check the import time of the modules listed in import_time_budget_ms in config.json against their budget
+    :return:
+    list of dictionaries: import time, heavy libraries loaded, budget and whether the import is within budget
+    """
+    results = []
+    for module, budget in get_config()['import_time_budget_ms'].items():
+        result = measure_import_time(module)
+        result.update(budget_ms=budget, within_budget=result['import_time_ms'] <= budget)
+        if not result['within_budget']:
+            logger.warning(f"importing {module} takes {result['import_time_ms']:.0f}ms, budget is {budget}ms")
+        results.append(result)
+    return results
+
+
+if __name__ == '__main__':
+    if '--imports' in sys.argv[1:]:
+        import_results = check_import_budget()
+        print(json.dumps(import_results, indent=4))
+        sys.exit(0 if all(result['within_budget'] for result in import_results) else 1)
+    print(json.dumps(run_benchmark(), indent=4))
@@ -0,0 +1,93 @@
+"""
+Compact export of the logistic regression: the serving path only needs the coefficients, the intercept, the classes
+and the order of the features, saved in a small .npz file next to the pickled model (trainedmodel.npz).
+
+LinearModel computes the same predict / predict_proba as sklearn's binary LogisticRegression with NumPy only, so the
+API can load the model without importing sklearn and without unpickling arbitrary objects.
+
+author: Geoffroy de Gournay
+date: August 2022
+"""
+import os
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# version of the layout of the .npz file, checked when it is loaded
+format_version = 1
+
+
+def compact_path(model_path):
+    """
+    Path of the compact export of a pickled model: same name with the .npz extension
+    """
+    return os.path.splitext(model_path)[0] + '.npz'
+
+
+def export_model(model, feature_names, path):
+    """
+    Save the parameters of a fitted binary LogisticRegression
+    :param model: fitted sklearn LogisticRegression
+    :param feature_names: names of the features, in the order used for training
+    :param path: path of the .npz file
+    """
+    if len(model.classes_) != 2:
+        raise ValueError('only binary logistic regressions can be exported')
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, format_version=np.array(format_version), coef=model.coef_.ravel().astype(np.float64),
+                 intercept=np.asarray(model.intercept_, dtype=np.float64), classes=model.classes_,
+                 feature_names=np.array(feature_names, dtype=str))
+    os.replace(tmp_path, path)
+    logger.info(f'compact model saved in {path}')
+
+
+class LinearModel:
+    """
+    Binary logistic regression computed with NumPy, with the same interface as sklearn for prediction.
+    """
+
+    def __init__(self, coef, intercept, classes, feature_names):
+        self.coef_ = np.asarray(coef, dtype=np.float64)
+        self.intercept_ = np.asarray(intercept, dtype=np.float64)
+        self.classes_ = np.asarray(classes)
+        self.feature_names_in_ = np.asarray(feature_names)
+
+    def _matrix(self, X):
+        # features in the order of the training, whatever the order of the columns of a dataframe
+        if hasattr(X, 'columns'):
+            missing = [name for name in self.feature_names_in_ if name not in X.columns]
+            if missing:
+                raise ValueError(f'missing features: {missing}')
+            X = X[list(self.feature_names_in_)]
+        return np.asarray(X, dtype=np.float64)
+
+    def decision_function(self, X):
+        return self._matrix(X) @ self.coef_ + self.intercept_[0]
+
+    def predict_proba(self, X):
+        """
+        :param X: panda Dataframe or numpy array of features
+        :return:
+        numpy array of shape (n, 2): probabilities of the two classes
+        """
+        proba = 1.0 / (1.0 + np.exp(-self.decision_function(X)))
+        return np.column_stack([1.0 - proba, proba])
+
+    def predict(self, X):
+        return self.classes_[(self.decision_function(X) > 0).astype(np.int64)]
+
+
+def load_model(path):
+    """
+    Load a compact model
+    :param path: path of the .npz file
+    :return:
+    LinearModel
+    """
+    with np.load(path, allow_pickle=False) as content:
+        if int(content['format_version']) != format_version:
+            raise ValueError(f"unsupported compact model format {int(content['format_version'])} in {path}")
+        return LinearModel(content['coef'], content['intercept'], content['classes'], content['feature_names'])
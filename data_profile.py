@@ -0,0 +1,288 @@
+"""
+Data profile: statistics of every column of the ingested data (number of missing values, mean, standard deviation,
+quantiles), computed in a single pass over the data and saved next to it.
+
+The statistics are mergeable: moments are combined with the parallel variance formula and quantiles are estimated
+with a compacting sketch, so that a profile can be computed chunk by chunk on data larger than memory, and updated
+with the rows appended by the incremental ingestion without reading the rest of the data again.
+The profile is saved in output_folder_path/dataprofile.json together with the version of the data it describes; it is
+computed again only if the data changed in some other way.
+
+author: Geoffroy de Gournay
+date: August 2022
+"""
+import os
+import json
+import threading
+import logging
+
+import numpy as np
+
+from datastore import data_version, iter_dataset
+from settings import get_config, dataset_csv_path
+
+logger = logging.getLogger(__name__)
+
+
+class QuantileSketch:
+    """
+    Mergeable quantile sketch: values are kept in levels of at most `capacity` items, an item of level i standing for
+    2**i values. When a level is full it is sorted and every other item is promoted to the next level. Quantiles are
+    exact as long as fewer than `capacity` values have been added.
+    """
+
+    def __init__(self, capacity=256, levels=None):
+        self.capacity = capacity
+        self.levels = levels or [[]]
+        # alternate between promoting the even and the odd items, so that compactions don't bias the quantiles
+        self._offset = 0
+
+    def update(self, values):
+        self.levels[0].extend(float(v) for v in values)
+        self._compact()
+
+    def merge(self, other):
+        for i, items in enumerate(other.levels):
+            if i == len(self.levels):
+                self.levels.append([])
+            self.levels[i].extend(items)
+        self._compact()
+
+    def _compact(self):
+        i = 0
+        while i < len(self.levels):
+            if len(self.levels[i]) > self.capacity:
+                items = sorted(self.levels[i])
+                # keep an odd item at the current level so that no value is lost when the count is odd
+                keep = items[-1:] if len(items) % 2 else []
+                if i + 1 == len(self.levels):
+                    self.levels.append([])
+                self.levels[i + 1].extend(items[self._offset:len(items) - len(keep):2])
+                self.levels[i] = keep
+                self._offset = 1 - self._offset
+            i += 1
+
+    def quantile(self, q):
+        if len(self.levels) == 1:
+            if not self.levels[0]:
+                return float('nan')
+            return float(np.quantile(self.levels[0], q))
+        values = np.concatenate([np.asarray(items, dtype=float) for items in self.levels])
+        weights = np.concatenate([np.full(len(items), 2 ** i, dtype=float) for i, items in enumerate(self.levels)])
+        order = np.argsort(values)
+        cumulative = np.cumsum(weights[order])
+        position = np.searchsorted(cumulative, q * cumulative[-1])
+        return float(values[order][min(position, len(values) - 1)])
+
+    def to_dict(self):
+        return {'capacity': self.capacity, 'levels': self.levels}
+
+    @classmethod
+    def from_dict(cls, state):
+        return cls(state['capacity'], state['levels'])
+
+
+class ColumnProfile:
+    """
+    Statistics of a column: number of missing values and, for numerical columns, count, mean, sum of squared
+    deviations (m2), min, max and a quantile sketch.
+    """
+
+    def __init__(self, numeric, n_missing=0, count=0, mean=0.0, m2=0.0, minimum=None, maximum=None, sketch=None):
+        self.numeric = numeric
+        self.n_missing = n_missing
+        self.count = count
+        self.mean = mean
+        self.m2 = m2
+        self.minimum = minimum
+        self.maximum = maximum
+        self.sketch = sketch or QuantileSketch()
+
+    @classmethod
+    def from_series(cls, series):
+        numeric = series.dtype.kind in 'biuf'
+        profile = cls(numeric, n_missing=int(series.isna().sum()))
+        if not numeric:
+            return profile
+        values = series.dropna().to_numpy(dtype=float)
+        if len(values):
+            profile.count = len(values)
+            profile.mean = float(values.mean())
+            profile.m2 = float(((values - profile.mean) ** 2).sum())
+            profile.minimum = float(values.min())
+            profile.maximum = float(values.max())
+            profile.sketch.update(values)
+        return profile
+
+    def merge(self, other):
+        self.n_missing += other.n_missing
+        if not self.numeric or not other.count:
+            return
+        if not self.count:
+            self.count, self.mean, self.m2 = other.count, other.mean, other.m2
+            self.minimum, self.maximum = other.minimum, other.maximum
+        else:
+            count = self.count + other.count
+            delta = other.mean - self.mean
+            self.mean += delta * other.count / count
+            self.m2 += other.m2 + delta ** 2 * self.count * other.count / count
+            self.count = count
+            self.minimum = min(self.minimum, other.minimum)
+            self.maximum = max(self.maximum, other.maximum)
+        self.sketch.merge(other.sketch)
+
+    def std(self):
+        # sample standard deviation, as calculated by pandas
+        return float(np.sqrt(self.m2 / (self.count - 1))) if self.count > 1 else float('nan')
+
+    def to_dict(self):
+        state = {'numeric': self.numeric, 'n_missing': self.n_missing}
+        if self.numeric:
+            state.update({'count': self.count, 'mean': self.mean, 'm2': self.m2, 'minimum': self.minimum,
+                          'maximum': self.maximum, 'sketch': self.sketch.to_dict()})
+        return state
+
+    @classmethod
+    def from_dict(cls, state):
+        state = dict(state)
+        if 'sketch' in state:
+            state['sketch'] = QuantileSketch.from_dict(state['sketch'])
+        return cls(**state)
+
+
+class DataProfile:
+    """
+    Statistics of every column of a dataset
+    """
+
+    def __init__(self, n_rows=0, columns=None, version=None):
+        self.n_rows = n_rows
+        self.columns = columns or {}
+        self.version = version
+
+    @classmethod
+    def from_dataframe(cls, data):
+        return cls(len(data), {col: ColumnProfile.from_series(data[col]) for col in data.columns})
+
+    def merge(self, other):
+        self.n_rows += other.n_rows
+        for col, column_profile in other.columns.items():
+            if col in self.columns:
+                self.columns[col].merge(column_profile)
+            else:
+                self.columns[col] = column_profile
+
+    def summary(self, columns):
+        """
+        :param columns: numerical columns to describe
+        :return:
+        dictionary {column: {'mean': ..., 'median': ..., 'std_dev': ...}}
+        """
+        return {col: {'mean': self.columns[col].mean, 'median': self.columns[col].sketch.quantile(0.5),
+                      'std_dev': self.columns[col].std()} for col in columns}
+
+    def missing_ratios(self):
+        """
+        :return:
+        dictionary {column: fraction of missing values}
+        """
+        return {col: column_profile.n_missing / self.n_rows if self.n_rows else float('nan')
+                for col, column_profile in self.columns.items()}
+
+    def to_dict(self):
+        return {'version': self.version, 'n_rows': self.n_rows,
+                'columns': {col: column_profile.to_dict() for col, column_profile in self.columns.items()}}
+
+    @classmethod
+    def from_dict(cls, state):
+        columns = {col: ColumnProfile.from_dict(column_state) for col, column_state in state['columns'].items()}
+        return cls(state['n_rows'], columns, state['version'])
+
+
+def compute_profile(csv_path=None):
+    """
+    Compute the profile of a dataset in one pass, reading it chunk by chunk
+    :param csv_path: csv path of the dataset
+    :return:
+    DataProfile
+    """
+    csv_path = csv_path or dataset_csv_path()
+    logger.info(f'computing the profile of {csv_path}')
+    profile = DataProfile()
+    for chunk in iter_dataset(csv_path, get_config()['profile_chunksize']):
+        profile.merge(DataProfile.from_dataframe(chunk))
+    profile.version = data_version(csv_path)
+    return profile
+
+
+def profile_path(csv_path=None):
+    """
+    Path of the saved profile of a dataset: dataprofile.json in the folder of the dataset
+    """
+    csv_path = csv_path or dataset_csv_path()
+    return os.path.join(os.path.dirname(csv_path), 'dataprofile.json')
+
+
+def load_profile(csv_path=None):
+    """
+    Load the saved profile of a dataset
+    :param csv_path: csv path of the dataset
+    :return:
+    DataProfile, None if no profile has been saved
+    """
+    try:
+        with open(profile_path(csv_path), 'r') as f:
+            return DataProfile.from_dict(json.load(f))
+    except FileNotFoundError:
+        return None
+
+
+def save_profile(profile, csv_path=None):
+    path = profile_path(csv_path)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(profile.to_dict(), f)
+    os.replace(tmp_path, path)
+
+
+def record_ingestion(data, previous_version, csv_path=None):
+    """
+    Update the saved profile of a dataset after an ingestion
+    :param data: rows written by the ingestion
+    :param previous_version: version of the dataset before the ingestion, None if the dataset was rewritten
+    :param csv_path: csv path of the dataset
+    """
+    csv_path = csv_path or dataset_csv_path()
+    profile = load_profile(csv_path) if previous_version is not None else None
+    if profile is not None and profile.version == previous_version:
+        # only the new rows need to be profiled
+        profile.merge(DataProfile.from_dataframe(data))
+    else:
+        profile = DataProfile.from_dataframe(data) if previous_version is None else compute_profile(csv_path)
+    profile.version = data_version(csv_path)
+    save_profile(profile, csv_path)
+
+
+# last profile used in this process
+_cached_profile = None
+_cache_lock = threading.Lock()
+
+
+def get_profile():
+    """
+    Get the profile of the current version of the ingested data: from memory, from dataprofile.json, or computed
+    from the data (and then saved) if the data changed since the last profile
+    :return:
+    DataProfile
+    """
+    global _cached_profile
+    version = data_version(dataset_csv_path())
+    with _cache_lock:
+        if _cached_profile is not None and _cached_profile.version == version:
+            return _cached_profile
+        profile = load_profile()
+        if profile is None or profile.version != version:
+            profile = compute_profile()
+            save_profile(profile)
+        _cached_profile = profile
+        return profile
@@ -0,0 +1,246 @@
+"""
+Dataset storage: datasets are saved in a columnar binary format (parquet) and read back with column projection, the
+csv files being kept as an optional export.
+
+Callers keep using the csv path of a dataset (e.g. ingesteddata/finaldata.csv): the parquet store lives next to it
+with the same name and the .parquet extension (e.g. ingesteddata/finaldata.parquet). The store is either a single
+file, or a directory of part files when rows are appended by the incremental ingestion.
+A csv file that has no up-to-date parquet store (e.g. testdata/testdata.csv) is parsed once and converted.
+If pyarrow is not installed, or data_format is set to "csv" in config.json, every dataset is read from and written
+to csv.
+
+author: Geoffroy de Gournay
+date: August 2022
+"""
+import os
+import hashlib
+import shutil
+import logging
+from importlib.util import find_spec
+
+import pandas as pd
+
+from monitoring import counter
+from settings import get_config
+
+logger = logging.getLogger(__name__)
+
+csv_read_bytes = counter('csv_read_bytes_total', 'Bytes of csv files parsed')
+csv_written_bytes = counter('csv_written_bytes_total', 'Bytes of csv files written')
+
+# pyarrow is only imported when a parquet file is read
+parquet_available = find_spec('pyarrow') is not None
+
+
+def use_parquet():
+    return parquet_available and get_config()['data_format'] == 'parquet'
+
+
+def export_csv():
+    # when using parquet, also write datasets as csv files
+    return get_config()['export_csv'] or not use_parquet()
+
+
+def store_path(csv_path):
+    """
+    Path of the parquet store associated to a csv path
+    """
+    return os.path.splitext(csv_path)[0] + '.parquet'
+
+
+def _part_files(store):
+    if os.path.isdir(store):
+        return sorted(os.path.join(store, name) for name in os.listdir(store) if name.endswith('.parquet'))
+    return [store]
+
+
+def _mtime(store):
+    return max(os.stat(path).st_mtime_ns for path in _part_files(store) + [store])
+
+
+def _is_fresh(csv_path):
+    """
+    Check if the parquet store of a dataset exists and is at least as recent as its csv file
+    """
+    store = store_path(csv_path)
+    if not os.path.exists(store):
+        return False
+    if not os.path.exists(csv_path):
+        return True
+    return _mtime(store) >= os.stat(csv_path).st_mtime_ns
+
+
+def _remove_store(store):
+    if os.path.isdir(store):
+        shutil.rmtree(store)
+    elif os.path.exists(store):
+        os.remove(store)
+
+
+def _write_part(data, store, part_path):
+    # the temporary file is unique to this process, another one may be writing the same part, and hidden so that
+    # readers of a directory store skip it
+    folder, name = os.path.split(part_path)
+    tmp_path = os.path.join(folder, f'.{name}.{os.getpid()}.tmp')
+    try:
+        data.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, part_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    logger.info(f'{len(data)} rows saved in {store}')
+
+
+def dataset_exists(csv_path):
+    """
+    Check if a dataset has been saved, in any format
+    """
+    return (use_parquet() and os.path.exists(store_path(csv_path))) or os.path.exists(csv_path)
+
+
+def write_dataset(data, csv_path, append=False):
+    """
+    Save a dataset in the parquet store and, if export_csv is set in config.json, in csv.
+    :param data: panda Dataframe
+    :param csv_path: csv path of the dataset
+    :param append: if true, add the rows to the dataset instead of replacing it. In the parquet store the rows are
+    written in a new part file, so that existing data is never rewritten.
+    """
+    os.makedirs(os.path.dirname(csv_path) or '.', exist_ok=True)
+    store = store_path(csv_path)
+    existing = None
+    if use_parquet() and append and not os.path.isdir(store) and dataset_exists(csv_path):
+        # rows saved before as csv or as a single file become the first part of a directory store
+        existing = read_dataset(csv_path).astype(data.dtypes.to_dict())
+
+    if export_csv():
+        size = os.path.getsize(csv_path) if append and os.path.exists(csv_path) else 0
+        if append:
+            data.to_csv(csv_path, mode='a', header=False, index=False)
+        else:
+            data.to_csv(csv_path, index=False)
+        csv_written_bytes.inc(os.path.getsize(csv_path) - size)
+    if not use_parquet():
+        return
+
+    # the parquet store is written last, so that it is never older than the csv export
+    if not append or not os.path.isdir(store):
+        _remove_store(store)
+        os.mkdir(store)
+        if existing is not None:
+            _write_part(existing, store, os.path.join(store, 'part-00000.parquet'))
+    part_path = os.path.join(store, f'part-{len(_part_files(store)):05d}.parquet')
+    _write_part(data, store, part_path)
+
+
+def read_dataset(csv_path, columns=None, start=0):
+    """
+    Read a dataset, loading only the requested columns
+    :param csv_path: csv path of the dataset
+    :param columns: list of columns to load, default to every column
+    :param start: position of the first row to load, the rows before it are skipped. In the parquet store, the part
+    files holding only rows before it are not read.
+    :return:
+    panda Dataframe, indexed from 0
+    """
+    if use_parquet():
+        if _is_fresh(csv_path):
+            if start:
+                return _read_parts(store_path(csv_path), columns, start)
+            return pd.read_parquet(store_path(csv_path), columns=columns)
+        data = pd.read_csv(csv_path)
+        csv_read_bytes.inc(os.path.getsize(csv_path))
+        _convert(data, csv_path)
+        data = data if columns is None else data[columns]
+        return data.iloc[start:].reset_index(drop=True) if start else data
+
+    data = pd.read_csv(csv_path, usecols=columns, skiprows=range(1, start + 1))
+    csv_read_bytes.inc(os.path.getsize(csv_path))
+    return data if columns is None else data[columns]
+
+
+def _read_parts(store, columns, start):
+    """
+    Read the rows of a parquet store from position start, the number of rows of each part file being read from its
+    footer
+    """
+    import pyarrow.parquet as pq
+    paths = _part_files(store)
+    frames = []
+    for path in paths:
+        n_rows = pq.ParquetFile(path).metadata.num_rows
+        if start < n_rows:
+            frames.append(pd.read_parquet(path, columns=columns).iloc[start:])
+        start = max(start - n_rows, 0)
+    if not frames:
+        return pd.read_parquet(paths[-1], columns=columns).iloc[:0]
+    return pd.concat(frames, ignore_index=True)
+
+
+def _convert(data, csv_path):
+    """
+    Save a dataset parsed from csv in the parquet store, so that the next reads don't parse the csv again
+    """
+    store = store_path(csv_path)
+    try:
+        _remove_store(store)
+        _write_part(data, store, store)
+    except OSError as err:
+        # another process may be converting the same file, the next read will try again
+        logger.warning(f'could not convert {csv_path} to parquet: {err}')
+
+
+def dataset_columns(csv_path):
+    """
+    Get the names of the columns of a dataset without reading its data
+    :param csv_path: csv path of the dataset
+    :return:
+    list of column names
+    """
+    if use_parquet() and _is_fresh(csv_path):
+        import pyarrow.dataset as pa_dataset
+        return pa_dataset.dataset(store_path(csv_path), format='parquet').schema.names
+    return list(pd.read_csv(csv_path, nrows=0).columns)
+
+
+def iter_dataset(csv_path, chunksize, columns=None):
+    """
+    Read a dataset by chunks, so that memory usage doesn't depend on the size of the dataset
+    :param csv_path: csv path of the dataset
+    :param chunksize: maximum number of rows per chunk
+    :param columns: list of columns to load, default to every column
+    :return:
+    generator of panda Dataframes
+    """
+    if use_parquet() and _is_fresh(csv_path):
+        import pyarrow.parquet as pq
+        for path in _part_files(store_path(csv_path)):
+            for batch in pq.ParquetFile(path).iter_batches(batch_size=chunksize, columns=columns):
+                yield batch.to_pandas()
+    else:
+        csv_read_bytes.inc(os.path.getsize(csv_path))
+        for chunk in pd.read_csv(csv_path, chunksize=chunksize, usecols=columns):
+            yield chunk if columns is None else chunk[columns]
+
+
+def data_version(csv_path):
+    """
+    Version of a dataset derived from the size and modification time of its files: it changes every time the
+    dataset is written.
+    :param csv_path: csv path of the dataset
+    :return:
+    version string, None if the dataset doesn't exist
+    """
+    paths = [csv_path]
+    store = store_path(csv_path)
+    if use_parquet() and os.path.exists(store):
+        paths += _part_files(store)
+    signature = []
+    for path in paths:
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            signature.append(f'{path}:{stat.st_size}:{stat.st_mtime_ns}')
+    if not signature:
+        return None
+    return hashlib.sha1('|'.join(signature).encode()).hexdigest()[:16]
@@ -0,0 +1,154 @@
+"""
+Dependency audit: compare the versions recorded in requirements.txt with the installed versions and the latest
+versions available on the package index, without spawning pip.
+
+Installed versions are read in-process with importlib.metadata. Latest versions are read from a local snapshot of the
+package index (index_snapshot_path in config.json) so that the audit works on hosts without network access. The
+snapshot is only refreshed on demand, from a host that can reach the index:
+    python3 dependency_audit.py --refresh
+A snapshot older than index_snapshot_ttl_hours is still used, but reported as stale. Packages the snapshot doesn't know
+have no latest version and are neither reported up to date nor outdated.
+
+author: Geoffroy de Gournay
+date: August 2022
+"""
+import os
+import sys
+import json
+import logging
+import urllib.request
+from datetime import datetime, timedelta
+from importlib import metadata
+
+from settings import get_config
+
+logger = logging.getLogger(__name__)
+
+requirements_path = 'requirements.txt'
+
+
+def read_requirements(path=requirements_path):
+    """
+    Read the pinned requirements
+    :param path: path to requirements.txt
+    :return:
+    list of tuples (package name, pinned version)
+    """
+    with open(path, 'r') as req_file:
+        lines = [line.split('#')[0].strip() for line in req_file.read().split('\n')]
+    return [tuple(line.split('==')) for line in lines if '==' in line]
+
+
+def installed_version(package):
+    """
+    :param package: name of a package
+    :return:
+    installed version of the package, None if it is not installed
+    """
+    try:
+        return metadata.version(package)
+    except metadata.PackageNotFoundError:
+        return None
+
+
+def load_snapshot():
+    """
+    Load the local snapshot of the package index
+    :return:
+    dictionary {'fetched': ISO timestamp, 'latest': {package: latest version}}, None if there is no snapshot
+    """
+    try:
+        with open(get_config()['index_snapshot_path'], 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def snapshot_age(snapshot):
+    """
+    :param snapshot: snapshot of the package index, None if there is none
+    :return:
+    number of seconds since the snapshot was fetched, None if there is no snapshot
+    """
+    if snapshot is None:
+        return None
+    return int((datetime.now() - datetime.fromisoformat(snapshot['fetched'])).total_seconds())
+
+
+def snapshot_is_stale(snapshot):
+    snapshot_ttl = timedelta(hours=get_config()['index_snapshot_ttl_hours'])
+    return snapshot is None or snapshot_age(snapshot) > snapshot_ttl.total_seconds()
+
+
+def fetch_latest_version(package, timeout=5):
+    """
+    Ask the package index for the latest version of a package
+    :param package: name of a package
+    :param timeout: timeout of the request in seconds
+    :return:
+    latest version
+    """
+    url = get_config()['package_index_url'].format(package=package)
+    with urllib.request.urlopen(url, timeout=timeout) as response:
+        return json.load(response)['info']['version']
+
+
+def refresh_snapshot(packages=None):
+    """
+    Fetch the latest versions from the package index and save them in the local snapshot. Packages that can't be
+    fetched keep the version of the previous snapshot.
+    :param packages: names of the packages, default to the packages of requirements.txt
+    :return:
+    the new snapshot
+    """
+    packages = packages or [package for package, _ in read_requirements()]
+    previous = load_snapshot() or {'latest': {}}
+    latest = dict(previous['latest'])
+    for package in packages:
+        try:
+            latest[package] = fetch_latest_version(package)
+        except (OSError, ValueError, KeyError) as err:
+            logger.warning(f'could not get the latest version of {package}: {err}')
+    snapshot = {'fetched': datetime.now().isoformat(timespec='seconds'), 'latest': latest}
+    snapshot_path = get_config()['index_snapshot_path']
+
+    os.makedirs(os.path.dirname(snapshot_path) or '.', exist_ok=True)
+    tmp_path = snapshot_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(snapshot, f, indent=4, sort_keys=True)
+    os.replace(tmp_path, snapshot_path)
+    logger.info(f'package index snapshot saved in {snapshot_path}')
+    return snapshot
+
+
+def audit_dependencies():
+    """
+    Compare the versions of the dependencies, without network access
+    :return:
+    list of dictionaries, one for each package of requirements.txt:
+    [{'module': 'click', 'current': '7.1.2', 'installed': '7.1.2', 'latest': '8.1.3', 'up_to_date': False,
+      'stale': False, 'snapshot_age': 3600}, ...]
+    'current' is the version recorded in requirements.txt, 'installed' is None if the package is not installed,
+    'latest' is taken from the snapshot and is None if the snapshot doesn't know the package, in which case
+    'up_to_date' is None too. 'stale' tells if the snapshot is missing or older than index_snapshot_ttl_hours and
+    'snapshot_age' is its age in seconds, None if there is no snapshot.
+    """
+    snapshot = load_snapshot()
+    if snapshot is None:
+        snapshot_path = get_config()['index_snapshot_path']
+        logger.warning(f'no package index snapshot in {snapshot_path}, run "python3 dependency_audit.py --refresh"')
+    elif snapshot_is_stale(snapshot):
+        logger.warning(f"package index snapshot from {snapshot['fetched']} is stale")
+    latest = snapshot['latest'] if snapshot else {}
+    stale, age = snapshot_is_stale(snapshot), snapshot_age(snapshot)
+
+    return [{'module': package, 'current': current, 'installed': installed_version(package),
+             'latest': latest.get(package), 'up_to_date': current == latest[package] if package in latest else None,
+             'stale': stale, 'snapshot_age': age}
+            for package, current in read_requirements()]
+
+
+if __name__ == '__main__':
+    if '--refresh' in sys.argv[1:]:
+        refresh_snapshot()
+    print(json.dumps(audit_dependencies(), indent=4))
@@ -1,49 +1,173 @@
 """
 Model deployment.
 
+Every deployment is saved in its own version directory, prod_deployment_path/versions/<version>, which is never
+modified afterwards. The deployed version is the one the symbolic link prod_deployment_path/current points to: the
+link is replaced atomically once every file of the new version is written, so a reader never sees a half-copied model
+or a model with the score of another one. The API reloads the model when the link changes (see model_registry.py).
+
+Only the latest deployment_retention versions are kept. To list the versions and roll back:
+    python3 deployment.py --list
+    python3 deployment.py --rollback [version]
+
 author: Geoffroy de Gournay
 date: August 2022
 """
 import os
-import json
+import sys
+import shutil
+import hashlib
 import logging
+from datetime import datetime
+
+from settings import get_config
 
 logger = logging.getLogger(__name__)
 
-# Load config.json and correct path variable
-with open('config.json', 'r') as f:
-    config = json.load(f)
+# files of a deployment, the compact model, the feature schema, the drift reference and the training state are
+# optional for models trained without them
+deployed_files = ('trainedmodel.pkl', 'trainedmodel.npz', 'featureschema.json', 'latestscore.txt',
+                  'ingestedfiles.txt', 'driftreference.json', 'trainingstate.json')
+optional_files = ('trainedmodel.npz', 'featureschema.json', 'driftreference.json', 'trainingstate.json')
+
 
-dataset_csv_path = os.path.join(config['output_folder_path'])
-prod_deployment_path = os.path.join(config['prod_deployment_path'])
+def versions_folder():
+    return os.path.join(get_config()['prod_deployment_path'], 'versions')
+
+
+def list_versions():
+    """
+    :return:
+    names of the deployed versions, oldest first
+    """
+    folder = versions_folder()
+    if not os.path.isdir(folder):
+        return []
+    return sorted(name for name in os.listdir(folder) if not name.startswith('.'))
+
+
+def current_version():
+    """
+    :return:
+    name of the version currently deployed, None if there is none
+    """
+    current = os.path.join(get_config()['prod_deployment_path'], 'current')
+    if not os.path.islink(current):
+        return None
+    return os.path.basename(os.readlink(current))
+
+
+def activate(version):
+    """
+    Deploy a saved version by replacing the current link atomically
+    :param version: name of the version
+    """
+    prod_deployment_path = get_config()['prod_deployment_path']
+    if version not in list_versions():
+        raise ValueError(f'unknown version {version}')
+    tmp_link = os.path.join(prod_deployment_path, '.current.tmp')
+    if os.path.lexists(tmp_link):
+        os.remove(tmp_link)
+    os.symlink(os.path.join('versions', version), tmp_link)
+    os.replace(tmp_link, os.path.join(prod_deployment_path, 'current'))
+    logger.info(f'version {version} deployed')
 
 
 def deploy_model():
     """
-    function for deployment, copy the latest pickle file, the latestscore.txt value, and the ingestedfiles.txt file
-    into the deployment directory
+    function for deployment, copy the latest pickle file with its compact export and its feature schema, the
+    latestscore.txt value, the ingestedfiles.txt file, the drift reference and the training state of the model into
+    a new version directory, then make it the deployed version
+    :return:
+    name of the new version
     """
+    config = get_config()
+    dataset_csv_path = os.path.join(config['output_folder_path'])
+    prod_deployment_path = os.path.join(config['prod_deployment_path'])
     logger.info(
         f"Model deployment. Model, it's latest score, and the list of files used for training are saved in "
         f"{prod_deployment_path}")
     # source paths
-    model_path = os.path.join(config['output_model_path'], 'trainedmodel.pkl')
-    score_path = os.path.join(config['output_model_path'], 'latestscore.txt')
-    ingested_path = os.path.join(dataset_csv_path, 'ingestedfiles.txt')
-    sources = [model_path, score_path, ingested_path]
+    sources = {
+        'trainedmodel.pkl': os.path.join(config['output_model_path'], 'trainedmodel.pkl'),
+        'trainedmodel.npz': os.path.join(config['output_model_path'], 'trainedmodel.npz'),
+        'featureschema.json': os.path.join(config['output_model_path'], 'featureschema.json'),
+        'latestscore.txt': os.path.join(config['output_model_path'], 'latestscore.txt'),
+        'ingestedfiles.txt': os.path.join(dataset_csv_path, 'ingestedfiles.txt'),
+        'driftreference.json': os.path.join(config['output_model_path'], 'driftreference.json'),
+        'trainingstate.json': os.path.join(config['output_model_path'], 'trainingstate.json'),
+    }
+
+    names = [name for name in deployed_files if name not in optional_files or os.path.isfile(sources[name])]
+    # the version name sorts by date, the hash of the deployed files tells versions made in the same second apart
+    digest = hashlib.sha1()
+    for name in names:
+        with open(sources[name], 'rb') as f:
+            digest.update(name.encode() + b'\0' + f.read())
+    version = f"{datetime.now().strftime('%Y%m%d%H%M%S')}-{digest.hexdigest()[:8]}"
+
+    if version in list_versions():
+        # the same files have already been deployed in this second
+        logger.info(f'version {version} already saved')
+    else:
+        # write the version in a staging directory, renamed once complete
+        staging_path = os.path.join(versions_folder(), f'.{version}.{os.getpid()}.tmp')
+        shutil.rmtree(staging_path, ignore_errors=True)
+        os.makedirs(staging_path)
+        try:
+            for name in names:
+                shutil.copy2(sources[name], os.path.join(staging_path, name))
+            os.replace(staging_path, os.path.join(versions_folder(), version))
+        except BaseException as err:
+            shutil.rmtree(staging_path, ignore_errors=True)
+            # another deployment of the same files may have saved the version first
+            if not (isinstance(err, OSError) and version in list_versions()):
+                raise
+
+    activate(version)
+    remove_old_versions()
+    return version
 
-    # target paths
-    # make sure the target directory exists
-    if not os.path.isdir(prod_deployment_path):
-        os.mkdir(prod_deployment_path)
-    target_model = os.path.join(prod_deployment_path, 'trainedmodel.pkl')
-    target_score = os.path.join(prod_deployment_path, 'latestscore.txt')
-    target_ingested = os.path.join(prod_deployment_path, 'ingestedfiles.txt')
-    targets = [target_model, target_score, target_ingested]
 
-    for source, target in zip(sources, targets):
-        os.system(f'cp {source} {target}')
+def rollback(version=None):
+    """
+    Deploy a previous version again
+    :param version: name of the version, default to the version deployed before the current one
+    :return:
+    name of the deployed version
+    """
+    if version is None:
+        versions = list_versions()
+        current = current_version()
+        previous = versions[:versions.index(current)] if current in versions else []
+        if not previous:
+            raise ValueError('no previous version to roll back to')
+        version = previous[-1]
+    activate(version)
+    return version
+
+
+def remove_old_versions(keep=None):
+    """
+    Retention policy: remove the oldest versions, the current version is always kept
+    :param keep: number of versions kept, default to deployment_retention in config.json
+    """
+    keep = keep or get_config()['deployment_retention']
+    current = current_version()
+    versions = list_versions()
+    for version in versions[:max(len(versions) - keep, 0)]:
+        if version != current:
+            shutil.rmtree(os.path.join(versions_folder(), version))
+            logger.info(f'version {version} removed')
 
 
 if __name__ == '__main__':
-    deploy_model()
+    args = sys.argv[1:]
+    if '--list' in args:
+        for name in list_versions():
+            print(name + (' (current)' if name == current_version() else ''))
+    elif '--rollback' in args:
+        target = args[args.index('--rollback') + 1] if len(args) > args.index('--rollback') + 1 else None
+        print(f'{rollback(target)} deployed')
+    else:
+        deploy_model()
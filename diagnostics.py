@@ -5,40 +5,125 @@ author: Geoffroy de Gournay
 date: August 2022
 """
 
-import subprocess
-
-import pandas as pd
-import timeit
 import os
-import json
-import pickle
+import pandas as pd
 import logging
 
+from data_profile import get_profile
+from datastore import csv_read_bytes, csv_written_bytes
+from features import FeatureSchema, SchemaError, id_column, target_column
+from model_registry import get_model_schema
+from monitoring import histogram
+from settings import get_config, test_data_path
+
 logger = logging.getLogger(__name__)
 
-# Load config.json and get environment variables
-with open('config.json', 'r') as f:
-    config = json.load(f)
+predict_duration = histogram('model_predict_duration_seconds', 'Duration of the predictions of the deployed model',
+                             ('function',))
 
-dataset_csv_path = os.path.join(config['output_folder_path'], 'finaldata.csv')
+
+def get_features(data, schema=None):
+    """
+    Select the columns used by the model: every column except the corporation name and the target, which may both be
+    missing from data sent for prediction.
+    :param data: panda Dataframe
+    :param schema: FeatureSchema of the model, the features are then validated and given in the order of the training
+    :return:
+    float numpy array of the features if a schema is given, panda Dataframe with the model features only otherwise
+    (model trained without schema)
+    """
+    if schema is not None:
+        return schema.matrix(data)
+    features = data.drop(columns=[id_column, target_column], errors='ignore')
+    # without schema, every other column is a feature and must be numeric
+    FeatureSchema(features.columns, []).validate(features)
+    return features
 
 
 def model_predictions(data):
     """
-    Get model predictions: read the deployed model and a test dataset, calculate predictions
+    Get model predictions: get the deployed model from the model registry (it is only unpickled again when the
+    deployed file changes) and calculate predictions on a test dataset
     :param data: data we use for prediction represented as a panda Dataframe
     :return:
     list containing all predictions
     """
     logger.info('calculate model predictions')
-    production_path = os.path.join(config['prod_deployment_path'])
-    model_path = os.path.join(production_path, 'trainedmodel.pkl')
-    model = pickle.load(open(model_path, 'rb'))
-    X = data.iloc[:, 1:-1]
-    predictions = list(model.predict(X))
+    model, schema = get_model_schema()
+    with predict_duration.time(function='predict'):
+        X = get_features(data, schema)
+        predictions = list(model.predict(X))
     return predictions
 
 
+def model_predict_proba(data):
+    """
+    Get model predictions together with the probability of exiting, from a single pass of the deployed model
+    :param data: data we use for prediction represented as a panda Dataframe
+    :return:
+    tuple of numpy arrays: (predicted classes, probabilities of the positive class)
+    """
+    logger.info('calculate model predictions and probabilities')
+    return _predict_proba(*get_model_schema(), data)
+
+
+def _predict_proba(model, schema, data):
+    with predict_duration.time(function='predict_proba'):
+        X = get_features(data, schema)
+        if schema is not None:
+            schema.check_complete(X)
+        try:
+            probas = model.predict_proba(X)
+        except ValueError as err:
+            # data the model can't predict on, only checked by the model itself if it was trained without schema
+            raise SchemaError(str(err).split('\n')[0])
+        predictions = model.classes_[probas.argmax(axis=1)]
+    return predictions, probas[:, -1]
+
+
+def stream_predictions(chunks):
+    """
+    Calculate predictions chunk by chunk, so that memory usage only depends on the size of a chunk and not on the
+    size of the whole dataset. The model is fetched once so that every chunk is scored by the same model, even if a
+    new model is deployed in the meantime.
+    :param chunks: iterable of panda Dataframes, e.g. pd.read_csv(path, chunksize=n)
+    :return:
+    generator of tuples (chunk, predicted classes, probabilities of the positive class)
+    """
+    logger.info('calculate model predictions by chunks')
+    model, schema = get_model_schema()
+    for chunk in chunks:
+        if chunk.empty:
+            continue
+        predictions, probabilities = _predict_proba(model, schema, chunk)
+        yield chunk, predictions, probabilities
+
+
+def write_predictions(data_path, output_path, chunksize=None):
+    """
+    Calculate predictions for a csv file of any size and write them to a csv file, one chunk at a time
+    :param data_path: path to the csv file with the data to predict on
+    :param output_path: path to the csv file where predictions are written
+    :param chunksize: number of rows read at once, default to prediction_chunksize in config.json
+    :return:
+    number of predictions written
+    """
+    chunksize = chunksize or get_config()['prediction_chunksize']
+    n_rows = 0
+    chunks = pd.read_csv(data_path, chunksize=chunksize)
+    csv_read_bytes.inc(os.path.getsize(data_path))
+    for chunk, predictions, probabilities in stream_predictions(chunks):
+        result = pd.DataFrame({'prediction': predictions, 'probability': probabilities})
+        if id_column in chunk.columns:
+            result.insert(0, id_column, chunk[id_column].values)
+        result.to_csv(output_path, mode='w' if n_rows == 0 else 'a', header=n_rows == 0, index=False)
+        n_rows += len(result)
+    if n_rows:
+        csv_written_bytes.inc(os.path.getsize(output_path))
+    logger.info(f'{n_rows} predictions saved in {output_path}')
+    return n_rows
+
+
 def dataframe_summary():
     """
     Get summary statistics
@@ -46,17 +131,10 @@ def dataframe_summary():
     dictionary of statistics (mean, median, std deviation) related to each numerical column
     """
     logger.info('calculate statistics on the data')
-    data = pd.read_csv(dataset_csv_path)
-    X = data.iloc[:, 1:-1]
-    means = X.mean()
-    medians = X.median()
-    std_var = X.std()
-
-    col_stats = {}
-    for col in X.columns:
-        col_stats[col] = {'mean': means[col], 'median': medians[col], 'std_dev': std_var[col]}
-
-    return col_stats
+    profile = get_profile()
+    columns = [col for col, column_profile in profile.columns.items()
+               if column_profile.numeric and col not in (id_column, target_column)]
+    return profile.summary(columns)
 
 
 def missing_data():
@@ -67,67 +145,57 @@ def missing_data():
     Each element of the dictionary gives the percent of NA values in a particular column of the data.
     """
     logger.info('check for missing data')
-    data = pd.read_csv(dataset_csv_path)
-    missing = data.isna().sum()
-    n_data = data.shape[0]
-    missing = missing / n_data
-    return missing.to_dict()
+    return get_profile().missing_ratios()
 
 
 def execution_time():
     """
-    Get timings: calculate timing of training.py and ingestion.py.
+    Get timings: calculate timing of the ingestion and the training, run in-process against scratch directories by
+    the benchmark harness (see benchmark.py for min, p95 and peak memory).
     :return:
-    list of 2 timing values in seconds
+    list of 2 timing values in seconds: median timing of ingestion and of training
     """
     logger.info('calculate timing for ingestion and training')
-    # timing ingestion
-    starttime = timeit.default_timer()
-    os.system('python3 ingestion.py')
-    ingestion_timing = timeit.default_timer() - starttime
-
-    # timing training
-    starttime = timeit.default_timer()
-    os.system('python3 training.py')
-    training_timing = timeit.default_timer() - starttime
-
-    return [ingestion_timing, training_timing]
+    # imported here: the benchmark imports the ingestion and training stages, only needed for this diagnostic
+    from benchmark import run_benchmark
+    result = run_benchmark()
+    return [result['ingestion']['median'], result['training']['median']]
 
 
 def outdated_packages_list():
     """
     Check dependencies: checks the current and latest versions of all the modules that the scripts use
-    (the current version is recorded in requirements.txt).
+    (the current version is recorded in requirements.txt). Installed versions are read in-process and latest versions
+    come from the local snapshot of the package index (see dependency_audit.py), so no network access is needed.
 
     :return:
     Output a list of dictionaries, one for each package used: the first key will show the name of a Python
-    module that is used; the second key will show the currently installed version of that Python module, and
-    the third key will show the most recent available version of that Python module:
-    [{'module': 'click', 'current': '7.1.2', 'latest': '8.1.3'}, ...]
+    module that is used; the second key will show the version of that Python module recorded in requirements.txt,
+    the third key the installed version, and the fourth key will show the most recent available version of that
+    Python module, None if it is unknown. The other keys tell if the module is up to date and how old the snapshot is:
+    [{'module': 'click', 'current': '7.1.2', 'installed': '7.1.2', 'latest': '8.1.3', 'up_to_date': False,
+      'stale': False, 'snapshot_age': 3600}, ...]
     """
     logger.info('Check dependencies versions')
-    # current version of dependencies
-    with open('requirements.txt', 'r') as req_file:
-        requirements = req_file.read().split('\n')
-    requirements = [r.split('==') for r in requirements if r]
-    df = pd.DataFrame(requirements, columns=['module', 'current'])
+    from dependency_audit import audit_dependencies
+    return audit_dependencies()
 
-    # Get outdated dependencies using PIP
-    outdated_dep = subprocess.check_output(['pip', 'list', '--outdated']).decode('utf8')
-    outdated_dep = outdated_dep.split('\n')[2:]  # the first 2 items are not packages
-    outdated_dep = [x.split(' ') for x in outdated_dep if x]
-    outdated_dep = [[y for y in x if y] for x in outdated_dep]  # list of [package, current version, latest version]
-    outdated_dic = {x[0]: x[2] for x in outdated_dep}  # {package: latest version}
-    df['latest'] = df['module'].map(outdated_dic)
 
-    # if we're already using the latest version of a module, we fill latest with this version:
-    df['latest'].fillna(df['current'], inplace=True)
-    return df.to_dict('records')
+def run_diagnostics():
+    """
+    Run the data and environment diagnostics: missing data, timing of ingestion and training, and dependencies.
+    :return:
+    dictionary: {
+    'missing': missing values statistics,
+    'time_check': timing of training and ingestion,
+    'outdated': list of packages with version used and latest available version
+    }
+    """
+    return {'missing': missing_data(), 'time_check': execution_time(), 'outdated': outdated_packages_list()}
 
 
 if __name__ == '__main__':
-    test_data_path = os.path.join(config['test_data_path'], 'testdata.csv')
-    data = pd.read_csv(test_data_path)
+    data = pd.read_csv(test_data_path())
     y_pred = model_predictions(data)
     stats = dataframe_summary()
     missing = missing_data()
@@ -0,0 +1,343 @@
+"""
+Drift monitoring: compare the distribution of new data with the distribution of the training data, without labels
+and without reading the training data again.
+
+When the model is trained, a compact reference is saved next to it (driftreference.json): for each feature and for
+the score of the model (probability of exiting), the edges of bins holding the same share of the training data, and
+that share. New data is only counted in these bins, so batches are added incrementally, and the distance between the
+counts and the reference is measured with:
+- the population stability index (PSI): sum of (observed - expected) * ln(observed / expected) over the bins
+- the Kolmogorov-Smirnov statistic (KS) of the binned distributions: largest gap between the cumulative shares
+
+Two sources of new data are monitored against the deployed reference: the ingested rows (features only), counted by
+the ingestion, and the prediction traffic (features and scores), counted by the API. The counts are saved in
+output_model_path/drift, the API saving the counts of each worker in its own file at most every drift_flush_seconds.
+
+With a few rows, most bins are empty and the PSI is large even when nothing has changed (about 7 for 2 rows drawn from
+the training data). Drift is only reported once at least drift_min_rows values have been counted for a column.
+
+author: Geoffroy de Gournay
+date: August 2022
+"""
+import os
+import json
+import hashlib
+import threading
+import time
+import logging
+
+import numpy as np
+
+from settings import get_config, deployed_path
+
+logger = logging.getLogger(__name__)
+
+score_name = 'score'
+INGESTION, PREDICTIONS = 'ingestion', 'predictions'
+# floor of the shares in the PSI, so that an empty bin doesn't make it infinite
+min_share = 1e-4
+
+
+class DriftReference:
+    """
+    Bins and shares of the training data for each feature and for the score.
+    """
+
+    def __init__(self, bins):
+        """
+        :param bins: dictionary {name: {'edges': [...], 'shares': [...]}}, len(shares) = len(edges) + 1
+        """
+        self.bins = bins
+        self.reference_id = hashlib.sha1(json.dumps(bins, sort_keys=True).encode()).hexdigest()[:16]
+
+    @classmethod
+    def from_data(cls, features, scores, n_bins=None):
+        """
+        :param features: panda Dataframe or dictionary {name: numpy array} with the training features
+        :param scores: numpy array of the scores of the model on the training data
+        :param n_bins: number of bins, default to drift_bins in config.json
+        """
+        n_bins = n_bins or get_config()['drift_bins']
+        columns = {name: np.asarray(features[name], dtype=np.float64) for name in features}
+        columns[score_name] = np.asarray(scores, dtype=np.float64)
+        bins = {}
+        for name, values in columns.items():
+            values = values[~np.isnan(values)]
+            # inner edges at the quantiles of the training data, duplicated edges merged
+            edges = np.unique(np.quantile(values, np.linspace(0, 1, n_bins + 1)[1:-1])) if len(values) else []
+            counts = bin_counts(values, edges)
+            bins[name] = {'edges': [float(edge) for edge in edges],
+                          'shares': (counts / max(counts.sum(), 1)).tolist()}
+        return cls(bins)
+
+    def extended(self, monitor, n_rows):
+        """
+        Reference of the training data with new rows added, without reading the former rows again: the edges of the
+        bins are kept and the shares weighted by the number of rows. The shares of the score of the former rows are
+        the shares of the model they were trained with.
+        :param monitor: DriftMonitor of this reference, with the counts of the new rows
+        :param n_rows: number of rows of the training data of this reference
+        :return:
+        DriftReference
+        """
+        bins = {}
+        for name, spec in self.bins.items():
+            counts = np.asarray(spec['shares']) * n_rows + monitor.counts[name]
+            bins[name] = {'edges': spec['edges'], 'shares': (counts / max(counts.sum(), 1)).tolist()}
+        return DriftReference(bins)
+
+    def to_dict(self):
+        return {'reference_id': self.reference_id, 'bins': self.bins}
+
+    @classmethod
+    def from_dict(cls, state):
+        return cls(state['bins'])
+
+
+def bin_counts(values, edges):
+    """
+    Count values in the bins delimited by edges: (-inf, edges[0]), [edges[0], edges[1]), ..., [edges[-1], inf)
+    :return:
+    numpy array of len(edges) + 1 counts
+    """
+    values = values[~np.isnan(values)]
+    return np.bincount(np.searchsorted(edges, values, side='right'), minlength=len(edges) + 1)
+
+
+def psi(counts, shares):
+    """
+    Population stability index of observed counts against expected shares
+    """
+    observed = np.maximum(counts / max(counts.sum(), 1), min_share)
+    expected = np.maximum(np.asarray(shares), min_share)
+    return float(np.sum((observed - expected) * np.log(observed / expected)))
+
+
+def ks(counts, shares):
+    """
+    Kolmogorov-Smirnov statistic of observed counts against expected shares, on the bins
+    """
+    observed = np.cumsum(counts / max(counts.sum(), 1))
+    return float(np.max(np.abs(observed - np.cumsum(shares))))
+
+
+class DriftMonitor:
+    """
+    Counts of new data in the bins of a reference.
+    """
+
+    def __init__(self, reference, counts=None):
+        """
+        :param reference: DriftReference
+        :param counts: dictionary {name: list of counts}, default to empty counts
+        """
+        self.reference = reference
+        self.counts = {name: np.zeros(len(spec['shares']), dtype=np.int64) for name, spec in reference.bins.items()}
+        for name, values in (counts or {}).items():
+            if name in self.counts:
+                self.counts[name] += np.asarray(values, dtype=np.int64)
+
+    def observe(self, features=None, scores=None):
+        """
+        Add a batch of data
+        :param features: panda Dataframe, only the columns of the reference are counted
+        :param scores: numpy array of scores of the model
+        """
+        if features is not None:
+            for name in features.columns:
+                if name in self.counts and name != score_name:
+                    values = features[name].to_numpy(dtype=np.float64, na_value=np.nan)
+                    self.counts[name] += bin_counts(values, self.reference.bins[name]['edges'])
+        if scores is not None:
+            values = np.asarray(scores, dtype=np.float64)
+            self.counts[score_name] += bin_counts(values, self.reference.bins[score_name]['edges'])
+
+    def merge(self, other):
+        for name, values in other.counts.items():
+            self.counts[name] += values
+
+    def report(self):
+        """
+        :return:
+        dictionary {name: {'n': number of values counted, 'psi': ..., 'ks': ...}}, for the features and the score
+        that have been observed
+        """
+        report = {}
+        for name, counts in self.counts.items():
+            if counts.sum():
+                shares = self.reference.bins[name]['shares']
+                report[name] = {'n': int(counts.sum()), 'psi': psi(counts, shares), 'ks': ks(counts, shares)}
+        return report
+
+    def to_dict(self):
+        return {'reference_id': self.reference.reference_id,
+                'counts': {name: counts.tolist() for name, counts in self.counts.items()}}
+
+
+def reference_path(folder):
+    """
+    Path of the drift reference saved with a model
+    :param folder: folder of the model
+    """
+    return os.path.join(folder, 'driftreference.json')
+
+
+def save_reference(reference, folder):
+    path = reference_path(folder)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(reference.to_dict(), f)
+    os.replace(tmp_path, path)
+    logger.info(f'drift reference saved in {path}')
+
+
+# reference of the deployed model, reloaded when the file changes
+_deployed = {'signature': None, 'reference': None}
+_deployed_lock = threading.Lock()
+
+
+def deployed_reference():
+    """
+    :return:
+    DriftReference of the deployed model, None if it has no reference
+    """
+    path = deployed_path('driftreference.json')
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    signature = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    with _deployed_lock:
+        if _deployed['signature'] != signature:
+            with open(path, 'r') as f:
+                _deployed['reference'] = DriftReference.from_dict(json.load(f))
+            _deployed['signature'] = signature
+        return _deployed['reference']
+
+
+def _counts_folder():
+    return os.path.join(get_config()['output_model_path'], 'drift')
+
+
+def _write_counts(monitor, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(monitor.to_dict(), f)
+    os.replace(tmp_path, path)
+
+
+def load_monitor(source, reference=None):
+    """
+    Aggregate the saved counts of a source of data
+    :param source: INGESTION or PREDICTIONS
+    :param reference: DriftReference, default to the reference of the deployed model
+    :return:
+    DriftMonitor with the counts of every file of the source matching the reference, None if there is no reference
+    """
+    reference = reference or deployed_reference()
+    if reference is None:
+        return None
+    monitor = DriftMonitor(reference)
+    folder = _counts_folder()
+    names = os.listdir(folder) if os.path.isdir(folder) else []
+    for name in names:
+        if not (name.startswith(source) and name.endswith('.json')):
+            continue
+        try:
+            with open(os.path.join(folder, name), 'r') as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            continue
+        if state['reference_id'] == reference.reference_id:
+            monitor.merge(DriftMonitor(reference, state['counts']))
+        else:
+            # counts of a model that is no longer deployed
+            try:
+                os.remove(os.path.join(folder, name))
+            except FileNotFoundError:
+                pass
+    return monitor
+
+
+def observe_ingestion(data):
+    """
+    Count newly ingested rows against the reference of the deployed model
+    :param data: panda Dataframe of the ingested rows
+    """
+    reference = deployed_reference()
+    if reference is None or data.empty:
+        return
+    path = os.path.join(_counts_folder(), f'{INGESTION}.json')
+    monitor = load_monitor(INGESTION, reference)
+    monitor.observe(features=data)
+    _write_counts(monitor, path)
+
+
+class _TrafficMonitor:
+    """
+    Counts of the prediction traffic of this process, saved at most every drift_flush_seconds.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._monitor = None
+        self._last_flush = 0.0
+
+    def observe(self, features, scores):
+        reference = deployed_reference()
+        if reference is None:
+            return
+        with self._lock:
+            if self._monitor is None or self._monitor.reference.reference_id != reference.reference_id:
+                # a new model has been deployed, counting starts again
+                self._monitor = DriftMonitor(reference)
+            self._monitor.observe(features, scores)
+            if time.monotonic() - self._last_flush >= get_config()['drift_flush_seconds']:
+                self._flush()
+
+    def flush(self):
+        with self._lock:
+            if self._monitor is not None:
+                self._flush()
+
+    def _flush(self):
+        _write_counts(self._monitor, os.path.join(_counts_folder(), f'{PREDICTIONS}-{os.getpid()}.json'))
+        self._last_flush = time.monotonic()
+
+
+_traffic = _TrafficMonitor()
+
+
+def observe_predictions(features, scores):
+    """
+    Count a batch of prediction traffic against the reference of the deployed model
+    :param features: panda Dataframe sent for prediction
+    :param scores: numpy array of the probabilities of exiting predicted by the model
+    """
+    _traffic.observe(features, scores)
+
+
+def drift_report(source):
+    """
+    :param source: INGESTION or PREDICTIONS
+    :return:
+    dictionary {'reference_id': ..., 'n_rows': largest number of values counted for a column, 'max_psi': largest PSI of
+    the features and the score, 'drift': True if the PSI of a column with at least drift_min_rows values reaches
+    drift_psi_threshold in config.json, 'columns': PSI and KS for each feature and the score}, None if the deployed
+    model has no reference
+    """
+    if source == PREDICTIONS:
+        _traffic.flush()
+    monitor = load_monitor(source)
+    if monitor is None:
+        return None
+    config = get_config()
+    columns = monitor.report()
+    max_psi = max((value['psi'] for value in columns.values()), default=0.0)
+    # the PSI of a column with too few values is noise
+    drift = any(value['n'] >= config['drift_min_rows'] and value['psi'] >= config['drift_psi_threshold']
+                for value in columns.values())
+    return {'reference_id': monitor.reference.reference_id,
+            'n_rows': max((value['n'] for value in columns.values()), default=0), 'max_psi': max_psi,
+            'drift': drift, 'columns': columns}
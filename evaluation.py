@@ -0,0 +1,164 @@
+"""
+Model evaluation: the model is run once on a dataset and every metric (F1 score, precision, recall, confusion matrix,
+ROC-AUC, threshold curves) is derived from that single prediction pass.
+
+Evaluations are cached in memory by (model version, data version): scoring, the confusion matrix, the drift check and
+the report all read the same predictions instead of predicting again. A new deployment or a new ingestion changes the
+version, so a stale evaluation is never served.
+
+author: Geoffroy de Gournay
+date: August 2022
+"""
+import threading
+import logging
+from collections import OrderedDict
+
+import numpy as np
+
+from datastore import read_dataset, dataset_columns, data_version
+from diagnostics import get_features
+from features import target, target_column, complete_rows, labelled_columns
+from model_registry import get_registry
+from settings import test_data_path
+
+logger = logging.getLogger(__name__)
+
+# number of evaluations kept in memory
+max_cached_evaluations = 8
+
+
+class Evaluation:
+    """
+    Labels, predictions and probabilities of a model on a dataset, and the metrics derived from them.
+    """
+
+    def __init__(self, y_true, predictions, probabilities, model_version=None, data_version=None):
+        """
+        :param y_true: numpy array of true labels (0 or 1)
+        :param predictions: numpy array of predicted labels
+        :param probabilities: numpy array of probabilities of the positive class
+        :param model_version: version of the model
+        :param data_version: version of the dataset
+        """
+        self.y_true = np.asarray(y_true).astype(np.int64)
+        self.predictions = np.asarray(predictions).astype(np.int64)
+        self.probabilities = np.asarray(probabilities, dtype=np.float64)
+        self.model_version = model_version
+        self.data_version = data_version
+        # [[tn, fp], [fn, tp]], same layout as sklearn.metrics.confusion_matrix
+        self.confusion_matrix = np.bincount(2 * self.y_true + self.predictions, minlength=4).reshape(2, 2)
+
+    @property
+    def precision(self):
+        (_, fp), (_, tp) = self.confusion_matrix
+        return float(tp / (tp + fp)) if tp + fp else 0.0
+
+    @property
+    def recall(self):
+        (_, _), (fn, tp) = self.confusion_matrix
+        return float(tp / (tp + fn)) if tp + fn else 0.0
+
+    @property
+    def f1(self):
+        (_, fp), (fn, tp) = self.confusion_matrix
+        return float(2 * tp / (2 * tp + fp + fn)) if tp + fp + fn else 0.0
+
+    def roc_auc(self):
+        """
+        Area under the ROC curve, None if the data has a single class
+        """
+        from sklearn import metrics
+
+        if len(np.unique(self.y_true)) < 2:
+            return None
+        return float(metrics.roc_auc_score(self.y_true, self.probabilities))
+
+    def threshold_curve(self, thresholds=None):
+        """
+        Precision, recall and F1 score of the model for several decision thresholds, computed from the sorted
+        probabilities without predicting again
+        :param thresholds: decision thresholds, default to 0, 0.05, ..., 1
+        :return:
+        list of dictionaries {'threshold': ..., 'precision': ..., 'recall': ..., 'f1': ...}
+        """
+        thresholds = np.linspace(0, 1, 21) if thresholds is None else np.asarray(thresholds, dtype=np.float64)
+        order = np.argsort(-self.probabilities, kind='mergesort')
+        # number of positive labels among the k highest probabilities, for k = 0..n
+        true_positives = np.concatenate([[0], np.cumsum(self.y_true[order])])
+        # number of predicted positives for each threshold: probabilities >= threshold
+        n_predicted = np.searchsorted(-self.probabilities[order], -thresholds, side='right')
+        tp = true_positives[n_predicted]
+        fp = n_predicted - tp
+        fn = self.y_true.sum() - tp
+        with np.errstate(divide='ignore', invalid='ignore'):
+            precision = np.where(tp + fp > 0, tp / (tp + fp), 0.0)
+            recall = np.where(tp + fn > 0, tp / (tp + fn), 0.0)
+            f1 = np.where(2 * tp + fp + fn > 0, 2 * tp / (2 * tp + fp + fn), 0.0)
+        return [{'threshold': float(t), 'precision': float(p), 'recall': float(r), 'f1': float(f)}
+                for t, p, r, f in zip(thresholds, precision, recall, f1)]
+
+    def summary(self):
+        """
+        :return:
+        dictionary of the metrics
+        """
+        return {
+            'n_records': len(self.y_true),
+            'f1': self.f1,
+            'precision': self.precision,
+            'recall': self.recall,
+            'roc_auc': self.roc_auc(),
+            'confusion_matrix': self.confusion_matrix.tolist(),
+            'model_version': self.model_version,
+            'data_version': self.data_version,
+        }
+
+
+_evaluations = OrderedDict()
+_evaluations_lock = threading.Lock()
+
+
+def evaluate(data_path=None, model_path=None):
+    """
+    Evaluate a model on a labelled dataset, reusing the cached evaluation if neither the model nor the data changed
+    :param data_path: csv path of the dataset, default to the test data
+    :param model_path: path to the model, default to the model in production
+    :return:
+    Evaluation
+    """
+    data_path = data_path or test_data_path()
+    model, schema, model_version = get_registry(model_path).get_model_schema()
+    key = (model_version, data_version(data_path))
+    # the lock is held during the prediction pass, so that stages evaluating the same model and data at the same time
+    # share a single pass
+    with _evaluations_lock:
+        if key in _evaluations:
+            _evaluations.move_to_end(key)
+            return _evaluations[key]
+
+        # the features of the model and the target, every column but the corporation name for a model trained without
+        # schema
+        columns = (schema.names + [target_column] if schema is not None
+                   else labelled_columns(dataset_columns(data_path)))
+        data = read_dataset(data_path, columns=columns)
+        # reading a csv file for the first time saves its parquet store, which changes the version of the dataset
+        key = (model_version, data_version(data_path))
+        if key in _evaluations:
+            return _evaluations[key]
+
+        logger.info(f'evaluating the model on {data_path}')
+        data = data[complete_rows(data, columns)]
+        y_true = target(data)
+        probas = model.predict_proba(get_features(data, schema))
+        predictions = model.classes_[probas.argmax(axis=1)]
+        evaluation = Evaluation(y_true, predictions, probas[:, -1], *key)
+
+        _evaluations[key] = evaluation
+        if len(_evaluations) > max_cached_evaluations:
+            _evaluations.popitem(last=False)
+        return evaluation
+
+
+if __name__ == '__main__':
+    import json
+    print(json.dumps(evaluate().summary(), indent=4))
@@ -0,0 +1,178 @@
+"""
+Feature schema: names and dtypes of the features the model was trained on, saved next to the model
+(featureschema.json) and deployed with it.
+
+Every frame given to the model goes through the schema: it is validated once (missing or non numeric features raise
+a SchemaError, extra columns such as the corporation name or the target are ignored) and the features are copied
+column by column, by name, into a single contiguous float array. The model always sees the features in the order of
+the training, whatever the order of the columns of the frame, and no intermediate DataFrame is built.
+
+author: Geoffroy de Gournay
+date: August 2022
+"""
+import os
+import json
+import logging
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+id_column = 'corporation'
+target_column = 'exited'
+
+
+class SchemaError(ValueError):
+    """
+    A frame doesn't match the feature schema of the model.
+    """
+
+
+class FeatureSchema:
+    """
+    Ordered names and dtypes of the features of a model.
+    """
+
+    def __init__(self, names, dtypes):
+        """
+        :param names: names of the features, in the order used for training
+        :param dtypes: dtypes of the features in the training data, as strings
+        """
+        self.names = list(names)
+        self.dtypes = list(dtypes)
+
+    @classmethod
+    def from_data(cls, data):
+        """
+        Schema of the training data: every column except the corporation name and the target
+        :param data: panda Dataframe
+        """
+        names = feature_names(data.columns)
+        return cls(names, [str(data[name].dtype) for name in names])
+
+    def to_dict(self):
+        return {'features': [{'name': name, 'dtype': dtype} for name, dtype in zip(self.names, self.dtypes)]}
+
+    @classmethod
+    def from_dict(cls, state):
+        return cls([feature['name'] for feature in state['features']],
+                   [feature['dtype'] for feature in state['features']])
+
+    def validate(self, data):
+        """
+        Check that a frame has every feature of the schema, with a numeric dtype
+        :param data: panda Dataframe
+        """
+        missing = [name for name in self.names if name not in data.columns]
+        if missing:
+            raise SchemaError(f'missing features: {missing}')
+        invalid = [name for name in self.names if not pd.api.types.is_numeric_dtype(data[name].dtype)]
+        if invalid:
+            raise SchemaError(f'features must be numeric: {invalid}')
+
+    def matrix(self, data):
+        """
+        Build the feature matrix of a frame
+        :param data: panda Dataframe
+        :return:
+        C-contiguous float64 numpy array of shape (len(data), number of features)
+        """
+        self.validate(data)
+        X = np.empty((len(data), len(self.names)), dtype=np.float64)
+        for j, name in enumerate(self.names):
+            # missing values of the nullable integer columns become NaN
+            X[:, j] = data[name].to_numpy(dtype=np.float64, na_value=np.nan)
+        return X
+
+    def check_complete(self, X):
+        """
+        Check that a matrix built by the schema has no missing value, which the model can't predict on
+        :param X: float numpy array built by matrix
+        """
+        missing = [name for j, name in enumerate(self.names) if np.isnan(X[:, j]).any()]
+        if missing:
+            raise SchemaError(f'missing values in features: {missing}')
+
+    def columns(self, X):
+        """
+        Features of a matrix built by the schema, by name
+        :return:
+        dictionary {name: numpy array}, the arrays being views on X
+        """
+        return {name: X[:, j] for j, name in enumerate(self.names)}
+
+
+def feature_names(columns):
+    """
+    Features of a dataset, selected by name: every column except the corporation name and the target
+    :param columns: names of the columns of the dataset
+    :return:
+    list of names, in the order of the columns
+    """
+    return [name for name in columns if name not in (id_column, target_column)]
+
+
+def labelled_columns(columns):
+    """
+    Columns needed to train or evaluate a model: the features and the target
+    :param columns: names of the columns of the dataset
+    :return:
+    list of names, the target last
+    """
+    if target_column not in columns:
+        raise SchemaError(f'the dataset has no target column {target_column}')
+    return feature_names(columns) + [target_column]
+
+
+def target(data):
+    """
+    :param data: panda Dataframe with the target column
+    :return:
+    numpy array of the labels
+    """
+    return data[target_column].to_numpy()
+
+
+def complete_rows(data, names):
+    """
+    Rows of a frame without missing value in the given columns, the others can't be used to train or evaluate a model
+    :param data: panda Dataframe
+    :param names: names of the columns
+    :return:
+    boolean numpy array, one value per row
+    """
+    complete = data[names].notna().all(axis=1).to_numpy()
+    if not complete.all():
+        logger.warning(f'{int((~complete).sum())} row(s) with missing values left out')
+    return complete
+
+
+def schema_path(folder):
+    """
+    Path of the feature schema saved with a model
+    :param folder: folder of the model
+    """
+    return os.path.join(folder, 'featureschema.json')
+
+
+def save_schema(schema, folder):
+    path = schema_path(folder)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(schema.to_dict(), f)
+    os.replace(tmp_path, path)
+    logger.info(f'feature schema saved in {path}')
+
+
+def load_schema(folder):
+    """
+    :param folder: folder of the model
+    :return:
+    FeatureSchema saved with the model, None for a model trained without schema
+    """
+    try:
+        with open(schema_path(folder), 'r') as f:
+            return FeatureSchema.from_dict(json.load(f))
+    except FileNotFoundError:
+        return None
@@ -2,41 +2,176 @@
 File with scripts that automate the ML model scoring and monitoring process.
 
 This step includes checking for the criteria that will require model re-deployment, and re-deploying models as
-necessary.
+necessary. The steps are the stages of a pipeline (pipeline.py): a stage whose inputs haven't changed since its last
+run is not run again, so a run only costs what changed since the previous one.
 
 author: Geoffroy de Gournay
 date: August 2022
 """
-import json
 import os
 import logging
-import subprocess
+from functools import partial
 from datetime import datetime
 
-from ingestion import merge_multiple_dataframe
-from scoring import score_model
-from training import train_model
-from deployment import deploy_model
+from settings import get_config, dataset_csv_path, test_data_path, model_path, prod_model_path, deployed_path
+from manifest import find_new_data
+from pipeline import Pipeline, Stage
+
+# The pipeline stages (and pandas, sklearn...) are only imported by the stages that run: most cron runs find no new
+# data and run none of them.
 
 logging.basicConfig(filename='./logs.log', level=logging.INFO, format="%(name)s - %(levelname)s - %(message)s")
 logger = logging.getLogger(__name__)
 
-# Load config.json and get path variables
-with open('config.json', 'r') as f:
-    config = json.load(f)
 
-input_folder_path = os.path.join(config['input_folder_path'])
-output_folder_path = os.path.join(config['output_folder_path'])
-prod_deployment_path = os.path.join(config['prod_deployment_path'])
-output_model_path = os.path.join(config['output_model_path'])
+def dataset_files(csv_path):
+    """
+    Files holding a dataset: the csv file and the parquet store saved next to it by datastore.py
+    """
+    return [csv_path, os.path.splitext(csv_path)[0] + '.parquet']
+
+
+def first_implementation():
+    return not os.path.isfile(deployed_path('ingestedfiles.txt'))
+
+
+def ingest(results):
+    """
+    Check and read new data: ingest the source files whose content hasn't been ingested yet
+    :return:
+    names of the ingested files
+    """
+    logger.info('Checking if new data are available')
+    new_data = find_new_data()
+    if new_data:
+        logger.info(f'There are new data in {len(new_data)} file(s), we need to ingest them.')
+        from ingestion import ingest_new_files
+        ingest_new_files(new_data)
+    else:
+        logger.info('No new file found.')
+    return new_data
+
+
+def check_drift(results):
+    """
+    Check for model drift: the score from the deployed model on the newest ingested data is lower than its latest
+    score by more than score_drop_tolerance, or the rows ingested since the deployment are distributed differently
+    from the training data (see drift.py)
+    :return:
+    True if a new model must be trained and deployed
+    """
+    if first_implementation():
+        logger.info('No file has been ingested yet in production')
+        logger.info("First deployment in production of the model.")
+        return True
+    logger.info('checking for model drift using newly ingested data')
+    config = get_config()
+    with open(deployed_path('latestscore.txt'), 'r') as f:
+        latest_score = float(f.read())
+
+    from scoring import score_model
+    from drift import drift_report, INGESTION
+    new_score = score_model(dataset_csv_path(), prod_model_path())
+    score_drift = new_score < latest_score - config['score_drop_tolerance']
+    report = drift_report(INGESTION)
+    data_drift = report is not None and report['drift']
+    if report is not None:
+        logger.info(f"largest PSI of the ingested data: {report['max_psi']:.4f} on {report['n_rows']} row(s)"
+                    + ('' if report['n_rows'] >= config['drift_min_rows'] else
+                       f", less than drift_min_rows ({config['drift_min_rows']}): not used"))
+    model_drift = bool(score_drift or data_drift)
+    logger.info('Model drift found we need to train and deploy a new model' if model_drift else 'No drift found')
+    return model_drift
+
+
+def summary_stats(results):
+    from diagnostics import dataframe_summary
+    return dataframe_summary()
+
+
+def train(results):
+    # full or incremental training (training_mode in config.json), its training state (mode, training time, number of
+    # iterations) is the result of the stage
+    from training import train_model
+    return train_model()
+
+
+def deploy(results):
+    from deployment import deploy_model
+    deploy_model()
+
+
+def confusion_matrix(results):
+    from reporting import get_confusion_matrix
+    get_confusion_matrix()
+
+
+def api_report(results):
+    # run the diagnostics and the report of the API endpoints for the re-deployed model, in-process
+    logger.info('Running diagnostics and reporting')
+    from reporting import write_api_report
+    write_api_report()
+
+
+def retrain_needed(testing_mode, results):
+    if testing_mode and not results['check_drift']:
+        logger.info('as we are in testing mode process continue. Should stop in production')
+    return testing_mode or results['check_drift']
+
+
+def build_pipeline(testing_mode=False):
+    """
+    Stages of the full process
+    :param testing_mode: if true, the model is trained and deployed even if no drift is found
+    :return:
+    Pipeline
+    """
+    config = get_config()
+    output_folder_path = config['output_folder_path']
+    output_model_path = config['output_model_path']
+    data_files = dataset_files(dataset_csv_path())
+    test_files = dataset_files(test_data_path())
+    ingested_path = os.path.join(output_folder_path, 'ingestedfiles.txt')
+    score_path = os.path.join(output_model_path, 'latestscore.txt')
+    # model, compact model, feature schema, drift reference and training state
+    trained_files = [model_path(), os.path.splitext(model_path())[0] + '.npz',
+                     os.path.join(output_model_path, 'featureschema.json'),
+                     os.path.join(output_model_path, 'driftreference.json'),
+                     os.path.join(output_model_path, 'trainingstate.json')]
+    # counts of the rows ingested since the deployment (drift.py)
+    ingestion_drift_path = os.path.join(output_model_path, 'drift', 'ingestion.json')
+    prod_files = [deployed_path(name)
+                  for name in ('trainedmodel.pkl', 'trainedmodel.npz', 'featureschema.json', 'latestscore.txt',
+                               'ingestedfiles.txt', 'driftreference.json', 'trainingstate.json')]
+
+    return Pipeline([
+        # finding new data is cheap (manifest.py), it is done on every run
+        Stage('ingest', ingest, outputs=data_files + [ingested_path], cache=False),
+        Stage('check_drift', check_drift, inputs=data_files + prod_files + [ingestion_drift_path], after=['ingest']),
+        Stage('summary_stats', summary_stats, inputs=data_files,
+              outputs=[os.path.join(output_folder_path, 'dataprofile.json')], after=['ingest']),
+        Stage('train', train, inputs=data_files, outputs=trained_files, after=['check_drift'],
+              when=partial(retrain_needed, testing_mode)),
+        Stage('deploy', deploy, inputs=trained_files + [score_path, ingested_path], outputs=prod_files,
+              after=['train']),
+        Stage('confusion_matrix', confusion_matrix, inputs=[prod_model_path()] + test_files,
+              outputs=[os.path.join(output_model_path, f'confusionmatrix.{fmt}') for fmt in config['report_formats']],
+              after=['deploy']),
+        Stage('api_report', api_report, inputs=[prod_model_path()] + test_files + data_files,
+              outputs=[os.path.join(output_model_path, 'apireturns.txt')], after=['deploy', 'summary_stats']),
+    ])
 
 
 def go(testing_mode=False):
     """
     Full process of ML model scoring and monitoring
-    :param testing_mode: used to specify if we are testing or running in production.
+    :param testing_mode: used to specify if we are testing or running in production. In testing mode, every stage is
+    run.
     :return:
+    record of the run, with the status and the duration of each stage
     """
+    output_model_path = get_config()['output_model_path']
+
     exec_time = datetime.now().strftime("%m/%d/%Y, %H:%M:%S")
     msg = '*' * 10 + ' ' * 4 + f'{exec_time}: Running full process' + ' ' * 4 + '*' * 10
     logger.info(msg)
@@ -51,73 +186,10 @@ def go(testing_mode=False):
         os.mkdir(output_model_path)
         logger.info(f'Creation of directory {output_model_path} where the model will be saved')
 
-    # Check and read new data
-    # read ingestedfiles.txt
-    logger.info('Checking if new data are available')
-    try:
-        with open(os.path.join(prod_deployment_path, 'ingestedfiles.txt')) as f:
-            ingested_files = f.read().split('\n')
-        ingested_files = [f for f in ingested_files if f]  # remove any empty string
-        first_implementation = False
-    except FileNotFoundError:
-        logger.info('No file has been ingested yet in production')
-        logger.info('This is the first time the production model is deployed')
-        ingested_files = []
-        first_implementation = True
-    # determine whether the source data folder has files that aren't listed in ingestedfiles.txt
-    filenames = next(os.walk(input_folder_path), (None, None, []))[2]  # [] if no file
-    new_data = [file for file in filenames if file not in ingested_files]
-
-    # Deciding whether to proceed, part 1
-    # if we found new data, we should proceed, otherwise, we end the process here
-    if new_data:
-        logger.info('There are new data, we need to ingest them.')
-        merge_multiple_dataframe()
-    elif not testing_mode:
-        logger.info('No new file found, stop the process here.')
-        exit()
-    else:
-        logger.info('No new file found.')
-        logger.info('as we are in testing mode process continue. Should stop in production')
-
-    # Checking for model drift
-    if first_implementation:
-        model_drift = False
-    else:
-        # check whether the score from the deployed model is different from the score from the model that uses the
-        # newest ingested data
-        logger.info('checking for model drift using newly ingested data')
-        with open(os.path.join(prod_deployment_path, 'latestscore.txt'), 'r') as f:
-            latest_score = float(f.read())
-        model_path = os.path.join(prod_deployment_path, 'trainedmodel.pkl')
-        data_path = os.path.join(output_folder_path, 'finaldata.csv')
-
-        new_score = score_model(data_path, model_path)
-        model_drift = True if new_score < latest_score else False
-
-    # Deciding whether to proceed, part 2
-    # if we found model drift, we proceed. otherwise, we do end the process here
-    if not model_drift and not testing_mode and not first_implementation:
-        logger.info('No drift found, process stop here.')
-        exit()
-    elif first_implementation and not testing_mode:
-        logger.info("First deployment in production of the model.")
-    elif not testing_mode:
-        logger.info('Model drift found we need to train and deploy a new model')
-    else:
-        logger.info('No drift found')
-        logger.info('as we are in testing mode process continue. Should stop in production')
-
-    # Re-training
-    train_model()
-
-    # Re-deployment
-    deploy_model()
-
-    # Diagnostics and reporting
-    # run diagnostics.py and reporting.py for the re-deployed model
-    logger.info('Running diagnostics and reporting: execute apicalls.py')
-    subprocess.run(['python3', 'apicalls.py'])
+    run = build_pipeline(testing_mode).run(force=testing_mode)
+    logger.info(f"full process done in {run['duration']:.2f}s: " +
+                ', '.join(f"{name} {stage['status']}" for name, stage in run['stages'].items()))
+    return run
 
 
 if __name__ == '__main__':
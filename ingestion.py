@@ -4,56 +4,176 @@ Data ingestion process.
 author: Geoffroy de Gournay
 date: August 2022
 """
+import numpy as np
 import pandas as pd
 import os
-import json
+from concurrent.futures import ProcessPoolExecutor
+
+from datastore import write_dataset, dataset_exists, dataset_columns, data_version, csv_read_bytes
+from data_profile import record_ingestion
+from drift import observe_ingestion
+from manifest import record_ingested_files
+from settings import get_config
 import logging
 
 logger = logging.getLogger(__name__)
 
-# Load config.json and get input and output paths
-with open('config.json', 'r') as f:
-    config = json.load(f)
+# explicit types of the columns of the source files, so that every file is parsed the same way. The integer types are
+# nullable, so that a missing value is kept as NA (reported by the missing data diagnostics) instead of failing the
+# parsing of the file.
+column_dtypes = {
+    'corporation': str,
+    'lastmonth_activity': 'Int32',
+    'lastyear_activity': 'Int32',
+    'number_of_employees': 'Int32',
+    'exited': 'Int8',
+}
+
 
-input_folder_path = config['input_folder_path']
-output_folder_path = config['output_folder_path']
+def output_paths(output_folder=None):
+    """
+    Paths of the files written by the ingestion
+    :param output_folder: folder where ingested data is saved, default to output_folder_path
+    :return:
+    tuple of paths (finaldata.csv, ingestedfiles.txt, rowhashes.npy). rowhashes.npy holds the hashes of every row
+    already saved in finaldata.csv, used to remove duplicates without reading finaldata.csv again.
+    """
+    output_folder = output_folder or get_config()['output_folder_path']
+    return (os.path.join(output_folder, 'finaldata.csv'), os.path.join(output_folder, 'ingestedfiles.txt'),
+            os.path.join(output_folder, 'rowhashes.npy'))
 
 
-def merge_multiple_dataframe():
+def merge_multiple_dataframe(output_folder=None):
     """
     Function for data ingestion. Read all files in input_folder_path, concatenate them as a single dataframe, remove
     duplicates  and save the data in output_folder_path/finaldata.csv
+    :param output_folder: folder where ingested data is saved, default to output_folder_path
     """
     logger.info('starting data ingestion process')
-    # check for datasets
-    filenames = next(os.walk(input_folder_path), (None, None, []))[2]  # [] if no file
+    data_path, record_path, row_hashes_path = output_paths(output_folder)
+    # check for datasets, sorted so that the merged data doesn't depend on the order of the file system
+    input_folder_path = get_config()['input_folder_path']
+    filenames = sorted(next(os.walk(input_folder_path), (None, None, []))[2])  # [] if no file
 
     # compile the datasets together
-    data_list = []
-    for file in filenames:
-        data_list.append(pd.read_csv(os.path.join(input_folder_path, file)))
-    data = pd.concat(data_list)
+    data = read_source_files(filenames)
 
     # remove duplicates
     data = data.drop_duplicates(ignore_index=True)
 
-    # Write to an output file
-    data_path = os.path.join(output_folder_path, 'finaldata.csv')
-    try:
-        data.to_csv(data_path, index=False)
-    except FileNotFoundError:
-        os.mkdir(output_folder_path)
-        data.to_csv(data_path, index=False)
+    # Write to the output files (parquet store and csv export)
+    write_dataset(data, data_path)
+    save_row_hashes(row_hashes(data), row_hashes_path)
+    record_ingestion(data, previous_version=None, csv_path=data_path)
 
     # saving a record of the ingestion
-    record_path = os.path.join(output_folder_path, 'ingestedfiles.txt')
     with open(record_path, 'w') as f:
         for file in filenames:
             f.write(file + '\n')
+    record_ingested_files(filenames, output_folder, replace=True)
     logger.info(f"record of ingestion saved in {record_path}")
 
     return data
 
 
+def ingest_new_files(filenames, output_folder=None):
+    """
+    Incremental data ingestion: only read the files listed in filenames, remove the rows that are duplicated or
+    already ingested (using the row hashes saved during previous ingestions), then append the remaining rows to
+    output_folder_path/finaldata.csv and the file names to output_folder_path/ingestedfiles.txt. The content hashes
+    of the files are saved in the source manifest, and the new rows are counted by the drift monitoring.
+    If nothing has been ingested yet, fall back on a full ingestion with merge_multiple_dataframe.
+    :param filenames: names of the new files in input_folder_path
+    :param output_folder: folder where ingested data is saved, default to output_folder_path
+    :return:
+    panda Dataframe with the rows that have been added to finaldata.csv
+    """
+    data_path, record_path, row_hashes_path = output_paths(output_folder)
+    if not (dataset_exists(data_path) and os.path.isfile(row_hashes_path)):
+        logger.info('no previous ingestion found, ingesting every file')
+        return merge_multiple_dataframe(output_folder)
+
+    logger.info(f'starting incremental ingestion of {len(filenames)} file(s)')
+    columns = dataset_columns(data_path)
+    data = read_source_files(sorted(filenames))[columns].drop_duplicates(ignore_index=True)
+
+    # remove rows already ingested
+    ingested_hashes = np.load(row_hashes_path)
+    hashes = row_hashes(data)
+    is_new = ~np.isin(hashes, ingested_hashes)
+    data = data[is_new].reset_index(drop=True)
+
+    # append to the output files
+    previous_version = data_version(data_path)
+    write_dataset(data, data_path, append=True)
+    save_row_hashes(np.concatenate([ingested_hashes, hashes[is_new]]), row_hashes_path)
+    record_ingestion(data, previous_version, csv_path=data_path)
+    observe_ingestion(data)
+    with open(record_path, 'r') as f:
+        recorded = set(f.read().split('\n'))
+    with open(record_path, 'a') as f:
+        for file in filenames:
+            if file not in recorded:
+                f.write(file + '\n')
+    record_ingested_files(filenames, output_folder)
+    logger.info(f'{len(data)} new row(s) appended to {data_path}')
+
+    return data
+
+
+def read_source_file(path):
+    """
+    Parse one source file with the explicit column types
+    :param path: path to a csv file
+    :return:
+    panda Dataframe
+    """
+    return pd.read_csv(path, dtype=column_dtypes)
+
+
+def read_source_files(filenames, workers=None):
+    """
+    Parse source files in parallel with a pool of processes and concatenate them. Dataframes are concatenated in the
+    order of filenames whatever the order in which the workers finish, so the result is deterministic.
+    :param filenames: names of the files in input_folder_path
+    :param workers: number of processes, default to ingestion_workers in config.json
+    :return:
+    panda Dataframe
+    """
+    workers = workers or get_config()['ingestion_workers']
+    paths = [os.path.join(get_config()['input_folder_path'], file) for file in filenames]
+    # counted here: the metrics of the worker processes are not saved
+    csv_read_bytes.inc(sum(os.path.getsize(path) for path in paths))
+    if workers <= 1 or len(paths) <= 1:
+        data_list = [read_source_file(path) for path in paths]
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(paths))) as executor:
+            data_list = list(executor.map(read_source_file, paths))
+    return pd.concat(data_list, ignore_index=True)
+
+
+def row_hashes(data):
+    """
+    Hash each row of a dataframe
+    :param data: panda Dataframe
+    :return:
+    numpy array of uint64, one hash per row
+    """
+    return pd.util.hash_pandas_object(data, index=False).values
+
+
+def save_row_hashes(hashes, row_hashes_path):
+    """
+    Save the hashes of the ingested rows. The file is replaced atomically so that an interrupted ingestion never
+    leaves a truncated index behind.
+    :param hashes: numpy array of uint64
+    :param row_hashes_path: path of the file
+    """
+    tmp_path = row_hashes_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.save(f, hashes)
+    os.replace(tmp_path, row_hashes_path)
+
+
 if __name__ == '__main__':
     merge_multiple_dataframe()
@@ -0,0 +1,216 @@
+"""
+Local background job queue: slow work (e.g. diagnostics) is run outside of the process serving the API.
+
+Each job runs in its own python process, started with a lower CPU priority (job_nice in config.json), so that it
+doesn't share the GIL nor compete on equal terms for the CPU with the requests served by the API worker. The job
+function is given as 'module:function' and called by this module in the child process:
+    python jobs.py diagnostics:run_diagnostics <result path>
+The API worker only keeps a thread (one of job_workers) waiting for the process to exit.
+
+The state of every job is saved as a JSON file in the job folder, so that any process serving the API (e.g. any
+gunicorn worker) can report the status and the result of a job, whichever process runs it. The job queued or running
+for each kind of job is recorded in the folder too, so that the API workers don't start the same work twice. The
+result of the last completed job of each kind is also saved, to be served while a new job is running.
+
+author: Geoffroy de Gournay
+date: August 2022
+"""
+import os
+import sys
+import json
+import uuid
+import fcntl
+import subprocess
+import importlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from settings import get_config
+
+logger = logging.getLogger(__name__)
+
+# number of job files kept in the job folder
+max_saved_jobs = 100
+
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+
+
+def _now():
+    return datetime.now().isoformat(timespec='seconds')
+
+
+def _write_json(path, content):
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(content, f)
+    os.replace(tmp_path, path)
+
+
+def _read_json(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class JobQueue:
+    """
+    Run functions in background processes and keep track of their status and result.
+    """
+
+    def __init__(self, workers=None, folder=None):
+        """
+        :param workers: number of jobs run at the same time by this process, default to job_workers in config.json
+        :param folder: folder where jobs are saved, default to output_model_path/jobs
+        """
+        workers = workers or get_config()['job_workers']
+        self.folder = folder or os.path.join(get_config()['output_model_path'], 'jobs')
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job')
+
+    def submit(self, kind, target):
+        """
+        Queue a job. If a job of the same kind is already queued or running in any process, it is returned instead
+        of starting the same work twice.
+        :param kind: kind of job, e.g. 'diagnostics'
+        :param target: 'module:function', the function having no argument and returning a JSON serializable result
+        :return:
+        job record: dictionary with the job id, kind, status and timestamps
+        """
+        os.makedirs(self.folder, exist_ok=True)
+        with open(os.path.join(self.folder, '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            active = self.active(kind)
+            if active is not None:
+                return active
+            job = {'job_id': uuid.uuid4().hex, 'kind': kind, 'status': QUEUED, 'submitted': _now(),
+                   'started': None, 'finished': None, 'error': None, 'pid': os.getpid()}
+            self._save(job)
+            _write_json(self._active_path(kind), {'job_id': job['job_id']})
+        logger.info(f"job {job['job_id']} ({kind}) queued")
+        self._executor.submit(self._run, job, target)
+        self._prune()
+        return job
+
+    def active(self, kind):
+        """
+        :param kind: kind of job
+        :return:
+        record of the job of this kind queued or running, None if there is none. A job whose API process has died
+        is not active.
+        """
+        pointer = _read_json(self._active_path(kind))
+        job = self.get_job(pointer['job_id']) if pointer else None
+        if job is not None and job['status'] in (QUEUED, RUNNING) and _is_running(job['pid']):
+            return job
+        return None
+
+    def _run(self, job, target):
+        job = dict(job, status=RUNNING, started=_now())
+        self._save(job)
+        result_path = self._result_path(job['job_id'])
+        process = subprocess.run([sys.executable, os.path.abspath(__file__), target, result_path],
+                                 capture_output=True, text=True)
+        if process.returncode != 0:
+            logger.error(f"job {job['job_id']} ({job['kind']}) failed")
+            job.update(status=FAILED, finished=_now(), error=process.stderr[-10000:])
+            self._save(job)
+            return
+        job.update(status=DONE, finished=_now())
+        _write_json(self._latest_path(job['kind']), dict(job, result=_read_json(result_path)))
+        self._save(job)
+        logger.info(f"job {job['job_id']} ({job['kind']}) done")
+
+    def _job_path(self, job_id):
+        return os.path.join(self.folder, f'{job_id}.json')
+
+    def _result_path(self, job_id):
+        return os.path.join(self.folder, f'{job_id}.result.json')
+
+    def _latest_path(self, kind):
+        return os.path.join(self.folder, f'latest_{kind}.json')
+
+    def _active_path(self, kind):
+        return os.path.join(self.folder, f'active_{kind}.json')
+
+    def _save(self, job):
+        _write_json(self._job_path(job['job_id']), job)
+
+    def _prune(self):
+        # remove the oldest jobs, keeping the latest result of each kind
+        paths = [os.path.join(self.folder, name) for name in os.listdir(self.folder)
+                 if name.endswith('.json') and not name.startswith(('latest_', 'active_')) and '.result.' not in name]
+        if len(paths) <= max_saved_jobs:
+            return
+        for path in sorted(paths, key=os.path.getmtime)[:-max_saved_jobs]:
+            job_id = os.path.basename(path)[:-len('.json')]
+            for old_path in (path, self._result_path(job_id)):
+                if os.path.exists(old_path):
+                    os.remove(old_path)
+
+    def get_job(self, job_id):
+        """
+        :param job_id: id of a job
+        :return:
+        job record, None if the job doesn't exist
+        """
+        if not job_id.isalnum():
+            return None
+        return _read_json(self._job_path(job_id))
+
+    def get_result(self, job_id):
+        """
+        :param job_id: id of a completed job
+        :return:
+        result of the job, None if it is not available
+        """
+        if not job_id.isalnum():
+            return None
+        return _read_json(self._result_path(job_id))
+
+    def latest(self, kind):
+        """
+        :param kind: kind of job
+        :return:
+        record of the last completed job of this kind with its result under the key 'result', None if no job of this
+        kind has completed yet
+        """
+        return _read_json(self._latest_path(kind))
+
+    def latest_age(self, kind):
+        """
+        :param kind: kind of job
+        :return:
+        number of seconds since the last completed job of this kind finished, None if no job has completed yet
+        """
+        latest = self.latest(kind)
+        if latest is None:
+            return None
+        return (datetime.now() - datetime.fromisoformat(latest['finished'])).total_seconds()
+
+
+def run_job(target, result_path):
+    """
+    Run a job function in this process, with a lower CPU priority, and save its result
+    :param target: 'module:function'
+    :param result_path: JSON file where the result is saved
+    """
+    os.nice(get_config()['job_nice'])
+    module, function = target.split(':')
+    result = getattr(importlib.import_module(module), function)()
+    _write_json(result_path, result)
+
+
+if __name__ == '__main__':
+    run_job(*sys.argv[1:3])
@@ -0,0 +1,138 @@
+"""
+Manifest of the source files: size, modification time and content hash of every file of input_folder_path.
+
+The manifest of the files that have been ingested is saved in output_folder_path/sourcemanifest.json. To find new
+data, the source folder is scanned and only the files whose size or modification time changed since the manifest
+are read and hashed: a file counts as new data only if its content changed, whatever its name.
+Only the standard library is used, so that the check stays fast when there is nothing new.
+
+author: Geoffroy de Gournay
+date: August 2022
+"""
+import os
+import json
+import hashlib
+import logging
+
+from settings import get_config
+
+logger = logging.getLogger(__name__)
+
+block_size = 2 ** 20
+
+
+def manifest_path(output_folder=None):
+    """
+    Path of the manifest of the ingested files
+    :param output_folder: folder where ingested data is saved, default to output_folder_path
+    """
+    return os.path.join(output_folder or get_config()['output_folder_path'], 'sourcemanifest.json')
+
+
+def hash_file(path):
+    """
+    Hash the content of a file
+    :param path: path to the file
+    :return:
+    hexadecimal digest
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def scan_folder(folder, reference=None, filenames=None):
+    """
+    Build the manifest of the files of a folder. The content of a file is only hashed if its size or modification
+    time differ from the reference manifest; otherwise the hash of the reference is reused.
+    :param folder: folder to scan
+    :param reference: previous manifest
+    :param filenames: names of the files to scan, default to every file of the folder
+    :return:
+    manifest: dictionary {filename: {'size': ..., 'mtime_ns': ..., 'hash': ...}}
+    """
+    reference = reference or {}
+    if filenames is None:
+        filenames = next(os.walk(folder), (None, None, []))[2]  # [] if no file
+    manifest = {}
+    for file in sorted(filenames):
+        stat = os.stat(os.path.join(folder, file))
+        entry = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+        known = reference.get(file)
+        if known is not None and known['size'] == entry['size'] and known['mtime_ns'] == entry['mtime_ns']:
+            entry['hash'] = known['hash']
+        else:
+            entry['hash'] = hash_file(os.path.join(folder, file))
+        manifest[file] = entry
+    return manifest
+
+
+def changed_files(manifest, reference):
+    """
+    :param manifest: current manifest
+    :param reference: manifest of the ingested files
+    :return:
+    names of the files that are new or whose content changed
+    """
+    return [file for file, entry in manifest.items()
+            if file not in reference or reference[file]['hash'] != entry['hash']]
+
+
+def load_manifest(path=None):
+    """
+    :param path: path of the manifest, default to output_folder_path/sourcemanifest.json
+    :return:
+    manifest, empty if it has not been saved yet
+    """
+    try:
+        with open(path or manifest_path(), 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_manifest(manifest, path=None):
+    """
+    :param manifest: manifest to save
+    :param path: path of the manifest, default to output_folder_path/sourcemanifest.json
+    """
+    path = path or manifest_path()
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=4, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def find_new_data(input_folder=None, output_folder=None):
+    """
+    Find the source files whose content has not been ingested yet. If some files were only touched (new modification
+    time, same content), the manifest is updated so that they are not hashed again on the next check.
+    :param input_folder: folder of the source files, default to input_folder_path
+    :param output_folder: folder where ingested data is saved, default to output_folder_path
+    :return:
+    names of the new or modified files
+    """
+    input_folder = input_folder or get_config()['input_folder_path']
+    path = manifest_path(output_folder)
+    reference = load_manifest(path)
+    manifest = scan_folder(input_folder, reference)
+    new_files = changed_files(manifest, reference)
+    if not new_files and reference and manifest != reference:
+        logger.info('source files touched without change of content, updating the manifest')
+        save_manifest({**reference, **manifest}, path)
+    return new_files
+
+
+def record_ingested_files(filenames, output_folder=None, replace=False):
+    """
+    Add ingested source files to the manifest
+    :param filenames: names of the files of input_folder_path that have been ingested
+    :param output_folder: folder where ingested data is saved, default to output_folder_path
+    :param replace: if true, the manifest only lists filenames (full ingestion), otherwise they are added to it
+    """
+    path = manifest_path(output_folder)
+    reference = load_manifest(path)
+    manifest = scan_folder(get_config()['input_folder_path'], reference, filenames)
+    save_manifest(manifest if replace else {**reference, **manifest}, path)
@@ -0,0 +1,142 @@
+"""
+Model registry: keep the deployed model in memory and only reload it when the file on disk changes.
+
+If the compact export of the model (trainedmodel.npz, see compact_model.py) is saved next to the pickle file, it is
+loaded instead, unless compact_model is false in config.json: loading it doesn't need sklearn. The feature schema
+saved with the model (featureschema.json, see features.py) is loaded together with it.
+
+author: Geoffroy de Gournay
+date: August 2022
+"""
+import os
+import pickle
+import threading
+import timeit
+import logging
+
+from compact_model import compact_path, load_model
+from features import load_schema
+from monitoring import histogram
+from settings import get_config, prod_model_path
+
+logger = logging.getLogger(__name__)
+
+load_duration = histogram('model_load_duration_seconds', 'Duration of the loads of the model', ('format',))
+
+
+class ModelRegistry:
+    """
+    Hold a model loaded from a pickle file, or from its compact export. The model is loaded once per process and
+    reloaded only when the file signature (inode, size, modification time) changes, e.g. after deploy_model switched
+    the deployed version.
+    """
+
+    def __init__(self, model_path):
+        self.model_path = model_path
+        self._lock = threading.Lock()
+        # (model, feature schema, signature of the file it was loaded from), replaced as a whole so that they always
+        # match
+        self._current = (None, None, None)
+        self.load_count = 0
+
+    def _artifact(self):
+        # file to load and its signature: the compact export if there is one, the pickle file otherwise. The path is
+        # resolved once, so that the model and its schema are read from the same version directory even if the
+        # deployed version is switched in the meantime.
+        model_path = os.path.realpath(self.model_path)
+        if get_config()['compact_model']:
+            try:
+                path = compact_path(model_path)
+                stat = os.stat(path)
+                return path, (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+            except FileNotFoundError:
+                pass
+        stat = os.stat(model_path)
+        return model_path, (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+    def get_model(self):
+        """
+        Return the model, loading it first if the file has never been read or has changed since the last load.
+        """
+        return self.get_versioned_model()[0]
+
+    def get_versioned_model(self):
+        """
+        Return the model with its version, loading it first if needed
+        :return:
+        tuple (model, version): the version is a string identifying the model file the model was loaded from
+        """
+        model, _, version = self.get_model_schema()
+        return model, version
+
+    def get_model_schema(self):
+        """
+        Return the model with its feature schema and its version, loading them first if needed
+        :return:
+        tuple (model, FeatureSchema or None for a model trained without schema, version)
+        """
+        path, signature = self._artifact()
+        if signature != self._current[2]:
+            with self._lock:
+                # another thread may have loaded it while we were waiting for the lock
+                if signature != self._current[2]:
+                    self._load(path, signature)
+        model, schema, signature = self._current
+        return model, schema, '-'.join(str(value) for value in signature)
+
+    def _load(self, path, signature):
+        starttime = timeit.default_timer()
+        compact = path == compact_path(path)
+        if compact:
+            model = load_model(path)
+        else:
+            with open(path, 'rb') as f:
+                model = pickle.load(f)
+        schema = load_schema(os.path.dirname(path))
+        load_time = timeit.default_timer() - starttime
+
+        self._current = (model, schema, signature)
+        self.load_count += 1
+        load_duration.observe(load_time, format='compact' if compact else 'pickle')
+        logger.info(f'model loaded from {path} in {load_time:.4f}s (load #{self.load_count})')
+
+
+# one registry per model file, shared by every caller of the process
+_registries = {}
+_registries_lock = threading.Lock()
+
+
+def get_registry(model_path=None):
+    """
+    Get the registry in charge of a model file
+    :param model_path: path to the pickled model, default to the model in production
+    :return:
+    ModelRegistry
+    """
+    model_path = model_path or prod_model_path()
+    key = os.path.abspath(model_path)
+    with _registries_lock:
+        if key not in _registries:
+            _registries[key] = ModelRegistry(model_path)
+        return _registries[key]
+
+
+def get_model(model_path=None):
+    """
+    Get a model from the process-wide cache
+    :param model_path: path to the pickled model, default to the model in production
+    :return:
+    the unpickled model
+    """
+    return get_registry(model_path).get_model()
+
+
+def get_model_schema(model_path=None):
+    """
+    Get a model and its feature schema from the process-wide cache
+    :param model_path: path to the pickled model, default to the model in production
+    :return:
+    tuple (model, FeatureSchema or None)
+    """
+    model, schema, _ = get_registry(model_path).get_model_schema()
+    return model, schema
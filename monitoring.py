@@ -0,0 +1,291 @@
+"""
+Metrics: counters and latency histograms, exposed by the API at /metrics in the Prometheus text exposition format.
+
+Metrics are declared by the modules that update them, with counter() and histogram(). Updating a metric only adds to
+a few numbers in memory under a lock. Each process saves its metrics to its own snapshot file in
+output_model_path/metrics at most every metrics_flush_seconds, and when it exits. /metrics adds up the snapshots of
+every process: the gunicorn workers of the API, and the cron runs of the pipeline. The snapshots of processes that are
+no longer running are merged into a single file, so that their counts are kept without leaving a file per process.
+
+The module only uses the standard library, so that it doesn't slow down the import of the pipeline.
+
+author: Geoffroy de Gournay
+date: August 2022
+"""
+import os
+import json
+import time
+import bisect
+import atexit
+import fcntl
+import threading
+import logging
+from contextlib import contextmanager
+
+from settings import get_config
+
+logger = logging.getLogger(__name__)
+
+COUNTER, HISTOGRAM = 'counter', 'histogram'
+# upper bounds of the buckets of the latency histograms, in seconds
+latency_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+# upper bounds of the buckets of the histograms of numbers of rows
+size_buckets = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 100000, 1000000)
+RETIRED = 'metrics-retired.json'
+
+
+class Metric:
+    """
+    Counter or histogram, with one value for each combination of label values.
+    """
+
+    def __init__(self, kind, name, help_text, labels=(), buckets=None):
+        """
+        :param kind: COUNTER or HISTOGRAM
+        :param name: name of the metric
+        :param help_text: description of the metric
+        :param labels: names of the labels
+        :param buckets: upper bounds of the buckets of a histogram
+        """
+        self.kind = kind
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets or latency_buckets) if kind == HISTOGRAM else None
+        # {label values: count} for a counter, {label values: [bucket counts, sum]} for a histogram
+        self.values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def inc(self, amount=1, **labels):
+        """
+        Add to a counter
+        """
+        key = self._key(labels)
+        with _registry.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+        _registry.maybe_flush()
+
+    def observe(self, value, **labels):
+        """
+        Add a value to a histogram
+        """
+        key = self._key(labels)
+        with _registry.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            # bucket of the smallest upper bound >= value, the last one being +Inf
+            entry[0][bisect.bisect_left(self.buckets, value)] += 1
+            entry[1] += value
+        _registry.maybe_flush()
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Observe the duration of a block of code in a histogram
+        """
+        starttime = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - starttime, **labels)
+
+    def to_dict(self):
+        return {'type': self.kind, 'help': self.help, 'labels': list(self.labels), 'buckets': self.buckets,
+                'values': [[list(key), value] for key, value in self.values.items()]}
+
+
+class _Registry:
+    """
+    Metrics of this process, saved at most every metrics_flush_seconds.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+        self._flush_lock = threading.Lock()
+        self._last_flush = time.monotonic()
+
+    def get(self, kind, name, help_text, labels, buckets=None):
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = Metric(kind, name, help_text, labels, buckets)
+            return self.metrics[name]
+
+    def maybe_flush(self):
+        if time.monotonic() - self._last_flush >= get_config()['metrics_flush_seconds']:
+            self.flush()
+
+    def flush(self):
+        self._last_flush = time.monotonic()
+        with self._flush_lock:
+            with self.lock:
+                snapshot = {name: metric.to_dict() for name, metric in self.metrics.items() if metric.values}
+            if not snapshot:
+                return
+            try:
+                _write_json(os.path.join(metrics_folder(), f'metrics-{os.getpid()}.json'), snapshot)
+                _retire_snapshots()
+            except OSError as err:
+                logger.warning(f'could not save the metrics: {err}')
+
+
+_registry = _Registry()
+atexit.register(_registry.flush)
+
+
+def counter(name, help_text, labels=()):
+    """
+    Declare a counter, or get it if it has already been declared
+    :param name: name of the metric, e.g. csv_read_bytes_total
+    :param help_text: description of the metric
+    :param labels: names of the labels
+    :return:
+    Metric
+    """
+    return _registry.get(COUNTER, name, help_text, labels)
+
+
+def histogram(name, help_text, labels=(), buckets=None):
+    """
+    Declare a histogram, or get it if it has already been declared
+    :param name: name of the metric, e.g. api_request_duration_seconds
+    :param help_text: description of the metric
+    :param labels: names of the labels
+    :param buckets: upper bounds of the buckets, default to latency_buckets
+    :return:
+    Metric
+    """
+    return _registry.get(HISTOGRAM, name, help_text, labels, buckets)
+
+
+def metrics_folder():
+    return os.path.join(get_config()['output_model_path'], 'metrics')
+
+
+def _write_json(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(content, f)
+    os.replace(tmp_path, path)
+
+
+def _read_json(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def _is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _merge(total, snapshot):
+    """
+    Add the values of a snapshot to an aggregate of snapshots
+    """
+    for name, metric in snapshot.items():
+        current = total.setdefault(name, {**metric, 'values': []})
+        if current['type'] != metric['type'] or current['buckets'] != metric['buckets']:
+            # declared differently by another version of the code
+            continue
+        values = {tuple(key): value for key, value in current['values']}
+        for key, value in metric['values']:
+            key = tuple(key)
+            if key not in values:
+                values[key] = value
+            elif metric['type'] == COUNTER:
+                values[key] += value
+            else:
+                values[key] = [[a + b for a, b in zip(values[key][0], value[0])], values[key][1] + value[1]]
+        current['values'] = [[list(key), value] for key, value in values.items()]
+    return total
+
+
+def _retire_snapshots():
+    """
+    Merge the snapshots of the processes that are no longer running into a single file
+    """
+    folder = metrics_folder()
+    dead = [name for name in os.listdir(folder) if name.startswith('metrics-') and name.endswith('.json')
+            and name[8:-5].isdigit() and not _is_running(int(name[8:-5]))]
+    if not dead:
+        return
+    with open(os.path.join(folder, '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        retired = _read_json(os.path.join(folder, RETIRED))
+        for name in dead:
+            path = os.path.join(folder, name)
+            if os.path.exists(path):
+                _merge(retired, _read_json(path))
+        _write_json(os.path.join(folder, RETIRED), retired)
+        for name in dead:
+            try:
+                os.remove(os.path.join(folder, name))
+            except FileNotFoundError:
+                pass
+
+
+def collect():
+    """
+    Add up the metrics of every process, the metrics of this process being saved first
+    :return:
+    dictionary {name: {'type': ..., 'help': ..., 'labels': [...], 'buckets': [...], 'values': [[label values, value]]}}
+    """
+    _registry.flush()
+    folder = metrics_folder()
+    total = {}
+    # the lock makes sure that the snapshot of a retired process is not counted twice
+    os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(folder, '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_SH)
+        for name in sorted(os.listdir(folder)):
+            if name.startswith('metrics-') and name.endswith('.json'):
+                _merge(total, _read_json(os.path.join(folder, name)))
+    return total
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in list(zip(names, values)) + list(extra)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def render(metrics=None):
+    """
+    Text exposition format of the metrics
+    :param metrics: aggregate of the metrics, default to the metrics of every process (collect())
+    :return:
+    string
+    """
+    metrics = collect() if metrics is None else metrics
+    lines = []
+    for name in sorted(metrics):
+        metric = metrics[name]
+        lines += [f"# HELP {name} {metric['help']}", f"# TYPE {name} {metric['type']}"]
+        for key, value in sorted(metric['values']):
+            if metric['type'] == COUNTER:
+                lines.append(f"{name}{_labels(metric['labels'], key)} {value}")
+                continue
+            counts, total = value
+            cumulative = 0
+            for bound, count in zip(list(metric['buckets']) + ['+Inf'], counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{_labels(metric['labels'], key, [('le', str(bound))])} {cumulative}")
+            lines.append(f"{name}_sum{_labels(metric['labels'], key)} {total}")
+            lines.append(f"{name}_count{_labels(metric['labels'], key)} {cumulative}")
+    return '\n'.join(lines) + '\n'
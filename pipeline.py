@@ -0,0 +1,222 @@
+"""
+Pipeline runner: the stages of a pipeline declare the files they read (inputs), the files they write (outputs) and
+the stages they must run after. They are run in dependency order, independent stages in parallel.
+
+Artifacts are content addressed: the key of a stage is a hash of its name and of the content of its inputs. A stage
+whose key and outputs are unchanged since its last run is not run again, its previous result is reused. File hashes
+are cached with the size and modification time of the files, so only the files that changed are read.
+A stage can also be skipped with a condition on the results of the previous stages; the stages depending on it are
+then not run either.
+
+The state of the stages is saved in output_model_path/pipelinestate.json, and the status and duration of every stage
+of every run are appended to output_model_path/pipelineruns.jsonl.
+
+author: Geoffroy de Gournay
+date: August 2022
+"""
+import os
+import json
+import hashlib
+import timeit
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime
+
+from manifest import hash_file
+from monitoring import counter, histogram
+from settings import get_config
+
+logger = logging.getLogger(__name__)
+
+stage_runs = counter('pipeline_stage_total', 'Number of stages by status', ('stage', 'status'))
+stage_duration = histogram('pipeline_stage_duration_seconds', 'Duration of the stages that ran successfully',
+                           ('stage',))
+
+# status of a stage in a run
+DONE, CACHED, SKIPPED, BLOCKED, FAILED = 'done', 'cached', 'skipped', 'blocked', 'failed'
+
+
+class Stage:
+    """
+    A step of a pipeline.
+    """
+
+    def __init__(self, name, func, inputs=(), outputs=(), after=(), when=None, cache=True):
+        """
+        :param name: name of the stage
+        :param func: function called with the dictionary of the results of the previous stages, returning a JSON
+        serializable result
+        :param inputs: paths of the files or directories read by the stage
+        :param outputs: paths of the files or directories written by the stage
+        :param after: names of the stages that must run before this one
+        :param when: function called with the results of the previous stages, the stage is skipped if it returns false
+        :param cache: if false, the stage is run every time
+        """
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.after = list(after)
+        self.when = when
+        self.cache = cache
+
+
+def _read_json(path, default):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return default
+
+
+class Pipeline:
+    """
+    Run a set of stages.
+    """
+
+    def __init__(self, stages, workers=None, folder=None):
+        """
+        :param stages: list of Stage
+        :param workers: number of stages run at the same time, default to pipeline_workers in config.json
+        :param folder: folder of the state and the run history, default to output_model_path
+        """
+        self.stages = {stage.name: stage for stage in stages}
+        self.order = self._sort(stages)
+        self.workers = workers or get_config()['pipeline_workers']
+        folder = folder or get_config()['output_model_path']
+        self.state_path = os.path.join(folder, 'pipelinestate.json')
+        self.runs_path = os.path.join(folder, 'pipelineruns.jsonl')
+
+    def _sort(self, stages):
+        # topological order of the stages, stages without dependency between them keep their order
+        order, visiting = [], set()
+
+        def visit(stage):
+            if stage.name in order:
+                return
+            if stage.name in visiting:
+                raise ValueError(f'dependency cycle on stage {stage.name}')
+            visiting.add(stage.name)
+            for name in stage.after:
+                if name not in self.stages:
+                    raise ValueError(f'stage {stage.name} runs after unknown stage {name}')
+                visit(self.stages[name])
+            order.append(stage.name)
+
+        for stage in stages:
+            visit(stage)
+        return order
+
+    def _digest(self, path, files):
+        # hash of the content of a file or of every file of a directory, None if it doesn't exist
+        if os.path.isdir(path):
+            paths = sorted(os.path.join(root, name) for root, _, names in os.walk(path) for name in names)
+        elif os.path.isfile(path):
+            paths = [path]
+        else:
+            return None
+        digest = hashlib.blake2b(digest_size=16)
+        for file_path in paths:
+            stat = os.stat(file_path)
+            known = files.get(file_path)
+            if known is None or known['size'] != stat.st_size or known['mtime_ns'] != stat.st_mtime_ns:
+                known = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'hash': hash_file(file_path)}
+                files[file_path] = known
+            digest.update(os.path.relpath(file_path, path).encode() + known['hash'].encode())
+        return digest.hexdigest()
+
+    def _key(self, stage, files):
+        content = {path: self._digest(path, files) for path in stage.inputs}
+        return hashlib.blake2b(json.dumps([stage.name, content], sort_keys=True).encode(), digest_size=16).hexdigest()
+
+    def _outputs(self, stage, files):
+        return {path: self._digest(path, files) for path in stage.outputs}
+
+    def _save_state(self, state):
+        # forget the files that have been removed, e.g. replaced part files
+        for path in [path for path in state['files'] if not os.path.exists(path)]:
+            del state['files'][path]
+        os.makedirs(os.path.dirname(self.state_path) or '.', exist_ok=True)
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.state_path)
+
+    def run(self, force=False):
+        """
+        Run the stages that are needed
+        :param force: if true, run every stage whose condition holds, even if its inputs are unchanged
+        :return:
+        record of the run: dictionary with the start time, the total duration and for each stage its status and its
+        duration in seconds. If a stage fails, the run is recorded and its exception is raised.
+        """
+        state = _read_json(self.state_path, {'stages': {}, 'files': {}})
+        files = state['files']
+        results, status, durations, keys = {}, {}, {}, {}
+        error = None
+        starttime = timeit.default_timer()
+        record = {'started': datetime.now().isoformat(timespec='seconds')}
+
+        def finish(name, stage_status, result=None):
+            status[name] = stage_status
+            results[name] = result
+            stage_runs.inc(stage=name, status=stage_status)
+            if stage_status == DONE:
+                stage_duration.observe(durations[name], stage=name)
+            logger.info(f'stage {name}: {stage_status}')
+
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='stage') as executor:
+            while len(status) < len(self.order):
+                # start every stage whose dependencies are finished
+                for name in self.order:
+                    stage = self.stages[name]
+                    if name in status or name in running.values() or any(dep not in status for dep in stage.after):
+                        continue
+                    if any(status[dep] in (SKIPPED, BLOCKED, FAILED) for dep in stage.after):
+                        finish(name, BLOCKED)
+                    elif stage.when is not None and not stage.when(results):
+                        finish(name, SKIPPED)
+                    else:
+                        keys[name] = self._key(stage, files)
+                        previous = state['stages'].get(name)
+                        if (not force and stage.cache and previous is not None and previous['key'] == keys[name]
+                                and previous['outputs'] == self._outputs(stage, files)):
+                            finish(name, CACHED, previous['result'])
+                        else:
+                            logger.info(f'stage {name}: running')
+                            running[executor.submit(self._run_stage, stage, dict(results))] = name
+                if not running:
+                    continue
+
+                completed, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in completed:
+                    name = running.pop(future)
+                    try:
+                        result, durations[name] = future.result()
+                    except Exception as err:
+                        logger.exception(f'stage {name} failed')
+                        error = error or err
+                        finish(name, FAILED)
+                        state['stages'].pop(name, None)
+                        continue
+                    finish(name, DONE, result)
+                    state['stages'][name] = {'key': keys[name], 'outputs': self._outputs(self.stages[name], files),
+                                             'result': result}
+                self._save_state(state)
+        self._save_state(state)
+
+        record['duration'] = timeit.default_timer() - starttime
+        record['stages'] = {name: {'status': status[name], 'duration': durations.get(name)} for name in self.order}
+        os.makedirs(os.path.dirname(self.runs_path) or '.', exist_ok=True)
+        with open(self.runs_path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+        if error is not None:
+            raise error
+        return record
+
+    @staticmethod
+    def _run_stage(stage, results):
+        starttime = timeit.default_timer()
+        result = stage.func(results)
+        return result, timeit.default_timer() - starttime
@@ -0,0 +1,197 @@
+"""
+Decoding of prediction requests and encoding of prediction responses for the API.
+
+Data can be sent directly in the body of the request:
+- a JSON array of records: [{"lastmonth_activity": 99, "lastyear_activity": 871, ...}, ...]
+- a columnar JSON object: {"lastmonth_activity": [99, 1243], "lastyear_activity": [871, 0], ...}
+- a raw CSV stream with a header line (Content-Type: text/csv)
+For backward compatibility a JSON object {"datapath": path} still reads a csv file saved on the server.
+
+author: Geoffroy de Gournay
+date: August 2022
+"""
+import json
+import logging
+
+import os
+
+import pandas as pd
+
+from datastore import csv_read_bytes
+
+logger = logging.getLogger(__name__)
+
+CSV_MIMETYPES = ('text/csv', 'application/csv')
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+
+class PayloadError(ValueError):
+    """
+    The body of a prediction request can't be turned into a dataframe.
+    """
+
+
+def read_request_data(request):
+    """
+    Build the dataframe to predict on from a flask request
+    :param request: flask request
+    :return:
+    panda Dataframe
+    """
+    if request.mimetype in CSV_MIMETYPES:
+        # parse the body as it is streamed, without writing it anywhere
+        csv_read_bytes.inc(request.content_length or 0)
+        try:
+            data = pd.read_csv(request.stream)
+        except (pd.errors.EmptyDataError, pd.errors.ParserError) as err:
+            raise PayloadError(f'invalid CSV body: {err}')
+        if data.empty:
+            raise PayloadError('no record to predict')
+        return data
+
+    payload = request.get_json(silent=True)
+    if payload is None:
+        raise PayloadError('expected a JSON or CSV body')
+    return payload_to_dataframe(payload)
+
+
+def read_request_records(request, max_records):
+    """
+    Get the records of a small JSON array body, without building a dataframe (used by the micro-batching)
+    :param request: flask request
+    :param max_records: maximum number of records
+    :return:
+    list of records, None if the body is not a JSON array of at most max_records records
+    """
+    if request.mimetype in CSV_MIMETYPES:
+        return None
+    payload = request.get_json(silent=True)
+    if (isinstance(payload, list) and 0 < len(payload) <= max_records
+            and all(isinstance(record, dict) for record in payload)):
+        return payload
+    return None
+
+
+def read_request_chunks(request, chunksize):
+    """
+    Read the data to predict on as a sequence of dataframes of at most chunksize rows. CSV bodies and csv files
+    given by 'datapath' are parsed lazily, one chunk at a time; JSON bodies are already decoded and give one chunk.
+    :param request: flask request
+    :param chunksize: maximum number of rows per chunk
+    :return:
+    iterable of panda Dataframes
+    """
+    if request.mimetype in CSV_MIMETYPES:
+        csv_read_bytes.inc(request.content_length or 0)
+        try:
+            return _checked_chunks(pd.read_csv(request.stream, chunksize=chunksize))
+        except pd.errors.EmptyDataError as err:
+            raise PayloadError(f'invalid CSV body: {err}')
+
+    payload = request.get_json(silent=True)
+    if payload is None:
+        raise PayloadError('expected a JSON or CSV body')
+    if isinstance(payload, dict) and 'datapath' in payload:
+        return _checked_chunks(_read_datapath(payload['datapath'], chunksize=chunksize))
+    return [payload_to_dataframe(payload)]
+
+
+def _checked_chunks(reader):
+    # chunks of a csv stream are parsed lazily: a malformed chunk is a payload error too
+    try:
+        yield from reader
+    except (pd.errors.EmptyDataError, pd.errors.ParserError) as err:
+        raise PayloadError(f'invalid CSV body: {err}')
+
+
+def _read_datapath(path, **kwargs):
+    # a missing, unreadable or malformed file is an error of the request, not of the server
+    try:
+        data = pd.read_csv(path, **kwargs)
+        csv_read_bytes.inc(os.path.getsize(path))
+    except (OSError, ValueError) as err:
+        raise PayloadError(f'invalid datapath {path}: {err}')
+    return data
+
+
+def payload_to_dataframe(payload):
+    """
+    Convert a decoded JSON payload into a dataframe
+    :param payload: list of records, dictionary of columns, or {'datapath': path}
+    :return:
+    panda Dataframe
+    """
+    if isinstance(payload, list):
+        if not payload:
+            raise PayloadError('no record to predict')
+        if not all(isinstance(record, dict) for record in payload):
+            raise PayloadError('a JSON array must contain one object per record')
+        return pd.DataFrame.from_records(payload)
+
+    if isinstance(payload, dict):
+        if 'datapath' in payload:
+            data = _read_datapath(payload['datapath'])
+            if data.empty:
+                raise PayloadError('no record to predict')
+            return data
+        if not all(isinstance(column, list) for column in payload.values()):
+            raise PayloadError('a JSON object must map each column name to a list of values')
+        try:
+            data = pd.DataFrame(payload)
+        except ValueError as err:
+            raise PayloadError(str(err))
+        if data.empty:
+            raise PayloadError('no record to predict')
+        return data
+
+    raise PayloadError('expected a JSON array of records or a JSON object of columns')
+
+
+def wants_ndjson(request):
+    """
+    Check if the client asked for newline delimited JSON, through the Accept header or ?format=ndjson
+    """
+    if request.args.get('format') == 'ndjson':
+        return True
+    return request.accept_mimetypes.best == NDJSON_MIMETYPE
+
+
+def _ids(data, id_column, n_rows):
+    if id_column in data.columns:
+        return data[id_column].tolist()
+    return [None] * n_rows
+
+
+def predictions_to_json(data, predictions, probabilities, id_column='corporation'):
+    """
+    Encode the predictions as a single JSON document
+    :param data: dataframe used for prediction, used to return the id of each record when available
+    :param predictions: numpy array of predicted classes
+    :param probabilities: numpy array of probabilities of the positive class
+    :param id_column: name of the column identifying a record
+    :return:
+    JSON string: {"n_records": n, "predictions": [...], "probabilities": [...], "corporation": [...]}
+    """
+    result = {
+        'n_records': len(predictions),
+        'predictions': predictions.tolist(),
+        'probabilities': probabilities.tolist(),
+    }
+    if id_column in data.columns:
+        result[id_column] = data[id_column].tolist()
+    return json.dumps(result)
+
+
+def predictions_to_ndjson(data, predictions, probabilities, id_column='corporation'):
+    """
+    Encode the predictions as newline delimited JSON, one line per record, so that large batches can be streamed
+    :param data: dataframe used for prediction, used to return the id of each record when available
+    :param predictions: numpy array of predicted classes
+    :param probabilities: numpy array of probabilities of the positive class
+    :param id_column: name of the column identifying a record
+    :return:
+    generator of JSON lines: {"corporation": ..., "prediction": 0, "probability": 0.12}
+    """
+    ids = _ids(data, id_column, len(predictions))
+    for record_id, prediction, probability in zip(ids, predictions.tolist(), probabilities.tolist()):
+        yield json.dumps({id_column: record_id, 'prediction': prediction, 'probability': probability}) + '\n'
@@ -0,0 +1,196 @@
+"""
+Rendering of the confusion matrix, in the format given by the extension of the output file:
+- .png: drawn by matplotlib with the non-interactive Agg canvas (no pyplot, no GUI backend). The figure is built once
+per process and reused as a template: rendering another matrix only updates the cells and the labels before saving.
+- .svg, .html and .txt: written as text, without importing any plotting library.
+
+render_batch renders several artifacts at once, the PNG files sharing the same figure.
+
+author: Geoffroy de Gournay
+date: August 2022
+"""
+import os
+import threading
+import logging
+from html import escape
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+class_labels = ('False', 'True')
+title = 'Confusion matrix'
+# stops of the blue color scale of the cells, from the lowest to the highest count
+color_stops = ((0.0, (247, 251, 255)), (0.25, (198, 219, 239)), (0.5, (107, 174, 214)), (0.75, (33, 113, 181)),
+               (1.0, (8, 48, 107)))
+
+
+def cell_color(share):
+    """
+    Color of a cell on the blue scale
+    :param share: position of the count between the lowest (0) and the highest (1) count
+    :return:
+    hex color, e.g. #6baed6
+    """
+    for (start, low), (end, high) in zip(color_stops, color_stops[1:]):
+        if share <= end:
+            ratio = (share - start) / (end - start)
+            rgb = [round(a + (b - a) * ratio) for a, b in zip(low, high)]
+            return '#' + ''.join(f'{value:02x}' for value in rgb)
+    return '#' + ''.join(f'{value:02x}' for value in color_stops[-1][1])
+
+
+def _shares(matrix):
+    low, high = matrix.min(), matrix.max()
+    return (matrix - low) / (high - low) if high > low else np.zeros(matrix.shape)
+
+
+def confusion_text(matrix, labels=class_labels):
+    """
+    Plain text table of a confusion matrix, actual values in rows and predicted values in columns
+    """
+    matrix = np.asarray(matrix)
+    width = max(len(str(value)) for value in list(matrix.ravel()) + list(labels) + ['Actual'])
+    lines = [title, '', ' ' * (width + 3) + 'Predicted',
+             f"{'Actual':>{width}} | " + ' '.join(f'{label:>{width}}' for label in labels)]
+    lines.append('-' * len(lines[-1]))
+    for label, row in zip(labels, matrix):
+        lines.append(f'{label:>{width}} | ' + ' '.join(f'{value:>{width}}' for value in row))
+    return '\n'.join(lines) + '\n'
+
+
+def confusion_svg(matrix, labels=class_labels, cell_size=120):
+    """
+    SVG heatmap of a confusion matrix
+    """
+    matrix = np.asarray(matrix)
+    shares = _shares(matrix)
+    n = len(matrix)
+    left, top = 90, 50
+    width, height = left + n * cell_size + 20, top + n * cell_size + 60
+    parts = [f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" '
+             f'font-family="sans-serif" font-size="14">',
+             f'<text x="{left + n * cell_size / 2}" y="25" text-anchor="middle" font-size="16">{title}</text>']
+    for i in range(n):
+        for j in range(n):
+            x, y = left + j * cell_size, top + i * cell_size
+            parts.append(f'<rect x="{x}" y="{y}" width="{cell_size}" height="{cell_size}" '
+                         f'fill="{cell_color(shares[i, j])}"/>')
+            parts.append(f'<text x="{x + cell_size / 2}" y="{y + cell_size / 2 + 5}" text-anchor="middle" '
+                         f'fill="{"white" if shares[i, j] > 0.5 else "black"}">{matrix[i, j]}</text>')
+        # class labels of the rows (actual values) and of the columns (predicted values)
+        parts.append(f'<text x="{left - 10}" y="{top + (i + 0.5) * cell_size + 5}" '
+                     f'text-anchor="end">{escape(labels[i])}</text>')
+        parts.append(f'<text x="{left + (i + 0.5) * cell_size}" y="{top + n * cell_size + 20}" '
+                     f'text-anchor="middle">{escape(labels[i])}</text>')
+    parts.append(f'<text x="{left + n * cell_size / 2}" y="{height - 10}" text-anchor="middle">Predicted Values</text>')
+    parts.append(f'<text x="20" y="{top + n * cell_size / 2}" text-anchor="middle" '
+                 f'transform="rotate(-90 20 {top + n * cell_size / 2})">Actual Values</text>')
+    parts.append('</svg>')
+    return '\n'.join(parts) + '\n'
+
+
+def confusion_html(matrix, labels=class_labels):
+    """
+    HTML page with a confusion matrix as a colored table
+    """
+    matrix = np.asarray(matrix)
+    shares = _shares(matrix)
+    rows = []
+    for i, label in enumerate(labels):
+        cells = ''.join(f'<td style="background:{cell_color(shares[i, j])};'
+                        f'color:{"white" if shares[i, j] > 0.5 else "black"}">{matrix[i, j]}</td>'
+                        for j in range(len(labels)))
+        rows.append(f'<tr><th>{escape(label)}</th>{cells}</tr>')
+    header = ''.join(f'<th>{escape(label)}</th>' for label in labels)
+    return ('<!DOCTYPE html>\n<html><head><meta charset="utf-8"><title>' + title + '</title>\n'
+            '<style>table{border-collapse:collapse;font-family:sans-serif}'
+            'td,th{padding:1em 2em;text-align:center}</style></head>\n<body>\n'
+            f'<h1>{title}</h1>\n<table>\n<tr><th>Actual \\ Predicted</th>{header}</tr>\n' + '\n'.join(rows) +
+            '\n</table>\n</body></html>\n')
+
+
+class _FigureTemplate:
+    """
+    Matplotlib figure of a confusion matrix, built once and updated for each matrix.
+    """
+
+    def __init__(self, n=2):
+        # the figure is drawn on an Agg canvas directly: pyplot and its GUI backends are never imported
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+        self.figure = Figure(figsize=(6, 6))
+        FigureCanvasAgg(self.figure)
+        self.ax = self.figure.add_subplot()
+        self.image = self.ax.imshow(np.zeros((n, n)), cmap='Blues')
+        self.colorbar = self.figure.colorbar(self.image, ax=self.ax)
+        self.texts = [[self.ax.text(j, i, '', ha='center', va='center') for j in range(n)] for i in range(n)]
+        self.ax.set_title(title)
+        self.ax.set_xlabel('\nPredicted Values')
+        self.ax.set_ylabel('Actual Values')
+        self.ax.set_xticks(range(n))
+        self.ax.set_yticks(range(n))
+        self.lock = threading.Lock()
+
+    def save(self, matrix, path, labels=class_labels):
+        shares = _shares(matrix)
+        with self.lock:
+            self.image.set_data(matrix)
+            self.image.set_clim(matrix.min(), max(matrix.max(), matrix.min() + 1))
+            self.colorbar.update_normal(self.image)
+            for i, row in enumerate(self.texts):
+                for j, text in enumerate(row):
+                    text.set_text(str(matrix[i, j]))
+                    text.set_color('white' if shares[i, j] > 0.5 else 'black')
+            self.ax.set_xticklabels(labels)
+            self.ax.set_yticklabels(labels)
+            self.figure.savefig(path)
+
+
+_templates = {}
+_templates_lock = threading.Lock()
+
+
+def _template(n):
+    with _templates_lock:
+        if n not in _templates:
+            _templates[n] = _FigureTemplate(n)
+        return _templates[n]
+
+
+text_renderers = {'.svg': confusion_svg, '.html': confusion_html, '.txt': confusion_text}
+formats = ('.png',) + tuple(text_renderers)
+
+
+def render_confusion_matrix(matrix, path, labels=class_labels):
+    """
+    Render a confusion matrix in the format given by the extension of path (.png, .svg, .html or .txt)
+    :param matrix: 2D array of counts, actual values in rows and predicted values in columns
+    :param path: output file
+    :param labels: names of the classes
+    :return:
+    path
+    """
+    matrix = np.asarray(matrix)
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.png':
+        _template(len(matrix)).save(matrix, path, labels)
+    elif extension in text_renderers:
+        with open(path, 'w') as f:
+            f.write(text_renderers[extension](matrix, labels))
+    else:
+        raise ValueError(f'unsupported format {extension}, expected one of {formats}')
+    logger.info(f'confusion matrix saved in {path}')
+    return path
+
+
+def render_batch(artifacts, labels=class_labels):
+    """
+    Render several artifacts in one call, the PNG files being drawn with the same figure
+    :param artifacts: iterable of tuples (matrix, path)
+    :param labels: names of the classes
+    :return:
+    list of paths
+    """
+    return [render_confusion_matrix(matrix, path, labels) for matrix, path in artifacts]
@@ -1,54 +1,114 @@
 """
-Plots generation related to the ML model's performance.
+Plots and reports related to the ML model's performance.
+
+The report of the API endpoints (apireturns.txt) is built in-process from the functions behind the endpoints, so
+no API server is needed. The confusion matrix, the predictions and the F1 score of the report all come from the same
+evaluation of the deployed model on the test data (see evaluation.py). The confusion matrix is rendered by
+rendering.py, in every format of report_formats in config.json.
 
 author: Geoffroy de Gournay
 date: August 2022
 """
 
-import pandas as pd
-from sklearn import metrics
-import matplotlib.pyplot as plt
-import seaborn as sns
-import json
 import os
+import sys
+import json
 import logging
 
-from diagnostics import model_predictions
+import pandas as pd
+
+from diagnostics import dataframe_summary, run_diagnostics
+from evaluation import evaluate
+from rendering import render_batch
+from settings import get_config
 
 logger = logging.getLogger(__name__)
 
-# Load config.json and get path variables
-with open('config.json', 'r') as f:
-    config = json.load(f)
+
+def confusion_matrix_paths(formats=None):
+    """
+    Paths of the confusion matrix files: output_model_path/confusionmatrix.<format>
+    :param formats: formats (png, svg, html or txt), default to report_formats in config.json
+    """
+    config = get_config()
+    formats = formats or config['report_formats']
+    return [os.path.join(config['output_model_path'], f'confusionmatrix.{fmt}') for fmt in formats]
 
 
-def get_confusion_matrix():
+def get_confusion_matrix(formats=None):
     """
     Reporting: calculate a confusion matrix using the test data and the deployed model. Write the confusion matrix to
-    the directory specified in the output_model_path entry of the config.json file.
+    the directory specified in the output_model_path entry of the config.json file, in each format in one batch.
+    :param formats: formats (png, svg, html or txt), default to report_formats in config.json. Only png needs a
+    plotting library.
     :return:
+    list of the paths of the files written
     """
-    test_data_path = os.path.join(config['test_data_path'], 'testdata.csv')
-    # true labels for test data
-    y_true = pd.read_csv(test_data_path)['exited'].values
+    # confusion matrix of the deployed model on the test data
+    confusion = evaluate().confusion_matrix
+    return render_batch((confusion, path) for path in confusion_matrix_paths(formats))
 
-    # labels predicted by the model
-    data = pd.read_csv(test_data_path)
-    y_pred = model_predictions(data)
 
-    # plot the confusion matrix
-    confusion = metrics.confusion_matrix(y_true, y_pred)
-    plt.figure(figsize=(6, 6))
-    ax = sns.heatmap(confusion, annot=True, cmap='Blues')
+def format_report(predictions, f1_score, statistics, diagnostics):
+    """
+    Combine the outputs of the API endpoints in a text report
+    :param predictions: list of predicted classes, as returned by /prediction
+    :param f1_score: f1 score, as returned by /scoring
+    :param statistics: summary statistics, as returned by /summarystats
+    :param diagnostics: result of the diagnostics, as returned by /diagnostics
+    :return:
+    text of the report
+    """
+    responses = "-" * 50 + '\n'
+    responses += " " * 10 + "** Model reporting **\n"
+    responses += "-" * 50 + '\n\n'
+    responses += " " * 10 + "Predictions:\n\n"
+    responses += str(predictions) + '\n'
+    responses += '-' * 50 + '\n'
+    responses += " " * 10 + "F1 score:\n\n"
+    responses += str(f1_score) + '\n'
+    responses += '-' * 50 + '\n'
+    responses += " " * 10 + "Statistics:\n\n"
+    df_stats = pd.DataFrame(statistics).T
+    responses += df_stats.to_string() + '\n'
+    responses += '-' * 50 + '\n'
+    responses += " " * 10 + "Diagnostics:\n\n"
+    responses += "missing data per column (%):\n"
+    responses += json.dumps(diagnostics['missing'], indent=4, sort_keys=True) + '\n\n'
+    responses += "Ingestion and training execution time:\n"
+    responses += str(diagnostics['time_check']) + '\n\n'
+    responses += "outdated packages:\n"
+    df = pd.DataFrame(diagnostics['outdated']).set_index('module')
+    responses += df.to_string() + '\n\n'
+    responses += '-' * 50 + '\n'
+    return responses
+
+
+def build_api_report():
+    """
+    Build the report of the API endpoints in-process, for the deployed model and the test data
+    :return:
+    text of the report
+    """
+    evaluation = evaluate()
+    return format_report(evaluation.predictions.tolist(), evaluation.f1, dataframe_summary(), run_diagnostics())
+
 
-    ax.set_title('Confusion matrix')
-    ax.set_xlabel('\nPredicted Values')
-    ax.set_ylabel('Actual Values')
-    ax.xaxis.set_ticklabels(['False', 'True'])
-    ax.yaxis.set_ticklabels(['False', 'True'])
-    plt.savefig(os.path.join(config['output_model_path'], 'confusionmatrix.png'))
-    logger.info(f"confusion matrix saved in {config['output_model_path']}")
+def write_api_report(output_path=None):
+    """
+    Write the report of the API endpoints
+    :param output_path: path of the report, default to output_model_path/apireturns.txt
+    :return:
+    path of the report
+    """
+    output_path = output_path or os.path.join(get_config()['output_model_path'], 'apireturns.txt')
+    report = build_api_report()
+    with open(output_path, 'w') as f:
+        f.write(report)
+    logger.info(f'report saved in {output_path}')
+    return output_path
 
 
 if __name__ == '__main__':
-    get_confusion_matrix()
+    # formats can be given on the command line, e.g. python3 reporting.py svg txt
+    get_confusion_matrix(sys.argv[1:] or None)
@@ -0,0 +1,114 @@
+"""
+HTTP caching of the API responses that only depend on versions of the model and of the data (/scoring,
+/summarystats).
+
+The ETag of a response is derived from the name of the endpoint and the versions it depends on, so it is known
+without computing the response: a request whose If-None-Match header holds the current ETag gets a 304 response right
+away. Other requests are served from an in-memory LRU cache of at most response_cache_size responses (entry of
+config.json), keyed by the same versions. A deployment changes the version of the model and an ingestion the version
+of the data, so their responses are never served again after a deploy or an ingestion, and they leave the cache as
+new responses are added.
+
+author: Geoffroy de Gournay
+date: August 2022
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+from functools import wraps
+
+from flask import Response, request
+
+from monitoring import counter
+from settings import get_config
+
+cache_requests = counter('response_cache_requests_total', 'Requests of the cached endpoints, by result: hit (served '
+                         'from the cache), miss (computed) or not_modified (304 response)', ('endpoint', 'result'))
+
+
+class ResponseCache:
+    """
+    Least recently used cache of response bodies, keyed by (endpoint, version).
+    """
+
+    def __init__(self, max_entries=None):
+        """
+        :param max_entries: maximum number of responses kept, default to response_cache_size in config.json
+        """
+        self.max_entries = max_entries or get_config()['response_cache_size']
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResponseCache()
+        return _cache
+
+
+def etag(name, version):
+    """
+    ETag of the response of an endpoint for a version of its inputs
+    """
+    return hashlib.blake2b(f'{name}|{version}'.encode(), digest_size=12).hexdigest()
+
+
+def cached_response(version_func, mimetype='application/json'):
+    """
+    Decorator of a flask view whose response only depends on the versions returned by version_func. The view must
+    return the body of the response as a string.
+    :param version_func: function without argument returning a string identifying the versions of the model and the
+    data the response depends on
+    :param mimetype: mimetype of the response
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            name = view.__name__
+            tag = etag(name, version_func())
+            if tag in request.if_none_match:
+                cache_requests.inc(endpoint=request.path, result='not_modified')
+                return _response('', tag, mimetype, status=304)
+
+            body = get_cache().get((name, tag))
+            cache_requests.inc(endpoint=request.path, result='miss' if body is None else 'hit')
+            if body is None:
+                body = view(*args, **kwargs)
+                # computing the response may change the version, e.g. when a csv file is converted to parquet
+                tag = etag(name, version_func())
+                get_cache().put((name, tag), body)
+            return _response(body, tag, mimetype)
+        return wrapper
+    return decorator
+
+
+def _response(body, tag, mimetype, status=200):
+    response = Response(body, status=status, mimetype=mimetype)
+    response.set_etag(tag)
+    # clients may keep the response but must check that it is still current
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
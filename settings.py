@@ -0,0 +1,64 @@
+"""
+Settings shared by every module: config.json is read once per process, the first time a setting is needed, instead
+of once by each module when it is imported.
+
+author: Geoffroy de Gournay
+date: August 2022
+"""
+import os
+import json
+from functools import lru_cache
+
+config_path = 'config.json'
+
+
+@lru_cache(maxsize=None)
+def get_config():
+    """
+    Load config.json and get path variables. The content is cached: it must not be modified by callers.
+    :return:
+    dictionary of settings
+    """
+    with open(config_path, 'r') as f:
+        return json.load(f)
+
+
+def dataset_csv_path():
+    """
+    Path to the ingested data: output_folder_path/finaldata.csv
+    """
+    return os.path.join(get_config()['output_folder_path'], 'finaldata.csv')
+
+
+def test_data_path():
+    """
+    Path to the test data: test_data_path/testdata.csv
+    """
+    return os.path.join(get_config()['test_data_path'], 'testdata.csv')
+
+
+def model_path():
+    """
+    Path to the trained model: output_model_path/trainedmodel.pkl
+    """
+    return os.path.join(get_config()['output_model_path'], 'trainedmodel.pkl')
+
+
+def deployed_path(name):
+    """
+    Path to a deployed file: prod_deployment_path/current/name, current pointing to the deployed version (see
+    deployment.py). Deployments made before versioned deployments saved their files in prod_deployment_path directly:
+    they are used until the next deployment.
+    :param name: name of the file, e.g. trainedmodel.pkl
+    """
+    current = os.path.join(get_config()['prod_deployment_path'], 'current')
+    if os.path.isdir(current):
+        return os.path.join(current, name)
+    return os.path.join(get_config()['prod_deployment_path'], name)
+
+
+def prod_model_path():
+    """
+    Path to the deployed model: prod_deployment_path/current/trainedmodel.pkl
+    """
+    return deployed_path('trainedmodel.pkl')
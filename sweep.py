@@ -0,0 +1,136 @@
+"""
+Hyperparameter sweep: every combination of C, penalty and solver of sweep_grid in config.json is evaluated with a
+stratified k-fold cross-validation (cv_folds folds), the configurations being spread over a pool of n_jobs processes
+(-1 for every core). The training matrix is saved once in a temporary .npy file that every worker memory-maps, so that
+it is not copied to each process. The configuration with the best mean F1 score is refitted on the whole dataset, and
+the results of the sweep are saved next to the model (sweepresults.json).
+
+author: Geoffroy de Gournay
+date: August 2022
+"""
+import os
+import json
+import shutil
+import tempfile
+import timeit
+import warnings
+import itertools
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from sklearn.exceptions import ConvergenceWarning
+from sklearn.linear_model import LogisticRegression
+from sklearn.model_selection import StratifiedKFold
+
+from settings import get_config
+
+logger = logging.getLogger(__name__)
+
+# penalties supported by each solver of LogisticRegression
+solver_penalties = {
+    'liblinear': ('l1', 'l2'),
+    'lbfgs': ('l2',),
+    'newton-cg': ('l2',),
+    'sag': ('l2',),
+    'saga': ('l1', 'l2'),
+}
+
+
+def sweep_configurations(grid=None):
+    """
+    Combinations of the grid, the penalties not supported by a solver being left out
+    :param grid: dictionary {'C': [...], 'penalty': [...], 'solver': [...]}, default to sweep_grid in config.json
+    :return:
+    list of dictionaries {'C': ..., 'penalty': ..., 'solver': ...}, in the order of the grid
+    """
+    grid = grid or get_config()['sweep_grid']
+    return [{'C': C, 'penalty': penalty, 'solver': solver}
+            for solver, penalty, C in itertools.product(grid['solver'], grid['penalty'], grid['C'])
+            if penalty in solver_penalties.get(solver, ())]
+
+
+def make_model(params):
+    return LogisticRegression(C=params['C'], penalty=params['penalty'], solver=params['solver'], max_iter=100,
+                              tol=0.0001, random_state=0)
+
+
+def _cross_validate(matrix_path, target_path, params, n_folds):
+    """
+    Cross-validate one configuration, run by a worker of the pool
+    :return:
+    dictionary with the parameters, the F1 score of each fold, their mean and standard deviation, and the time taken
+    """
+    # imported here: evaluation imports the model registry, only needed to compute the F1 score
+    from evaluation import Evaluation
+
+    starttime = timeit.default_timer()
+    X = np.load(matrix_path, mmap_mode='r')
+    y = np.load(target_path, mmap_mode='r')
+    scores = []
+    converged = True
+    for train_index, test_index in StratifiedKFold(n_splits=n_folds, shuffle=True, random_state=0).split(X, y):
+        model = make_model(params)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', ConvergenceWarning)
+            model.fit(X[train_index], y[train_index])
+        converged = converged and int(np.max(model.n_iter_)) < model.max_iter
+        X_test = X[test_index]
+        scores.append(Evaluation(y[test_index], model.predict(X_test), model.predict_proba(X_test)[:, -1]).f1)
+    return {'params': params, 'f1': float(np.mean(scores)), 'f1_std': float(np.std(scores)),
+            'fold_f1': [float(score) for score in scores], 'converged': converged,
+            'time': timeit.default_timer() - starttime}
+
+
+def run_sweep(X, y, output_folder, n_jobs=None, n_folds=None, grid=None):
+    """
+    Cross-validate every configuration of the grid and refit the best one on the whole dataset
+    :param X: float numpy array of the features
+    :param y: numpy array of the labels
+    :param output_folder: folder where sweepresults.json is saved
+    :param n_jobs: number of processes, -1 for every core, default to n_jobs in config.json
+    :param n_folds: number of folds, default to cv_folds in config.json. It is reduced to the number of rows of the
+    smallest class if needed.
+    :param grid: grid of parameters, default to sweep_grid in config.json
+    :return:
+    tuple (best model fitted on the whole dataset, results of the sweep)
+    """
+    config = get_config()
+    n_jobs = n_jobs or config['n_jobs']
+    n_jobs = os.cpu_count() if n_jobs < 0 else n_jobs
+    n_folds = min(n_folds or config['cv_folds'], int(np.bincount(y.astype(np.int64)).min()))
+    if n_folds < 2:
+        raise ValueError('not enough rows of each class for a cross-validation')
+    configurations = sweep_configurations(grid)
+    logger.info(f'sweep of {len(configurations)} configurations, {n_folds}-fold cross-validation, {n_jobs} process(es)')
+
+    starttime = timeit.default_timer()
+    # the training data is saved once and memory-mapped by every worker
+    folder = tempfile.mkdtemp(prefix='sweep-')
+    try:
+        matrix_path, target_path = os.path.join(folder, 'X.npy'), os.path.join(folder, 'y.npy')
+        np.save(matrix_path, np.ascontiguousarray(X))
+        np.save(target_path, np.asarray(y))
+        args = [(matrix_path, target_path, params, n_folds) for params in configurations]
+        if n_jobs <= 1 or len(configurations) <= 1:
+            results = [_cross_validate(*arg) for arg in args]
+        else:
+            with ProcessPoolExecutor(max_workers=min(n_jobs, len(configurations))) as executor:
+                results = list(executor.map(_cross_validate, *zip(*args)))
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+    # best mean F1 score, the first configuration of the grid in case of a tie
+    best = max(range(len(results)), key=lambda i: (results[i]['f1'], -i))
+    model = make_model(results[best]['params'])
+    model.fit(X, y)
+    sweep = {'n_folds': n_folds, 'n_jobs': n_jobs, 'time': timeit.default_timer() - starttime,
+             'best': results[best], 'results': results}
+    logger.info(f"best configuration {results[best]['params']}: F1 score {results[best]['f1']:.4f}, sweep done in "
+                f"{sweep['time']:.2f}s")
+
+    path = os.path.join(output_folder, 'sweepresults.json')
+    with open(path, 'w') as f:
+        json.dump(sweep, f, indent=2)
+    logger.info(f'sweep results saved in {path}')
+    return model, sweep
@@ -1,52 +1,315 @@
 """
 Model training..
 
+Three training modes, set by training_mode in config.json:
+- full: the logistic regression is fitted on the whole dataset.
+- sweep: the hyperparameters (C, penalty, solver) are chosen by a parallel cross-validation (see sweep.py), then the
+best configuration is fitted on the whole dataset.
+- incremental: the deployed model is updated with the rows ingested since it was trained only. The objective of the
+logistic regression on the rows already fitted is replaced by its quadratic approximation around the deployed
+coefficients, whose gradient and Hessian are saved with the model (trainingstate.json). The update minimizes this
+approximation plus the log-loss of the new rows with Newton's method, for at most incremental_max_iter iterations: it
+approximates the full refit on every row, instead of forgetting what the deployed model learned. The new rows are
+found with the row hashes of the ingestion (rowhashes.npy): the deployed model records how many rows it was trained on
+and a digest of their hashes, so that a dataset rewritten since then is detected. Only these new rows are read, and
+the drift reference of the deployed model is extended with them.
+The incremental training falls back to a full refit when it can't be used (no quadratic approximation in the deployed
+training state or no drift reference, dataset rewritten, new rows with a single class, different features), when
+Newton's method doesn't converge within incremental_max_iter iterations, or when its F1 score on the test data is
+lower than the score of the deployed model by more than score_drop_tolerance.
+
+The training time and the number of iterations of the solver are logged and saved in trainingstate.json.
+
 author: Geoffroy de Gournay
 date: August 2022
 """
 
-import pandas as pd
 import pickle
 import os
-from sklearn.linear_model import LogisticRegression
+import sys
 import json
+import hashlib
+import timeit
+import numpy as np
+from scipy.special import expit
+from sklearn.linear_model import LogisticRegression
 import logging
 
+from compact_model import compact_path, export_model
+from datastore import read_dataset, dataset_columns
+from drift import DriftReference, DriftMonitor, save_reference, deployed_reference
+from features import FeatureSchema, save_schema, target, target_column, complete_rows, feature_names, labelled_columns
+from settings import get_config, dataset_csv_path, model_path, test_data_path, prod_model_path, deployed_path
+
 logger = logging.getLogger(__name__)
 
-# Load config.json and get path variables
-with open('config.json', 'r') as f:
-    config = json.load(f)
+FULL, INCREMENTAL, SWEEP = 'full', 'incremental', 'sweep'
+
 
-dataset_csv_path = os.path.join(config['output_folder_path'], 'finaldata.csv')
-model_path = os.path.join(config['output_model_path'], 'trainedmodel.pkl')
+def training_state_path(folder):
+    """
+    Path of the training state saved with a model
+    :param folder: folder of the model
+    """
+    return os.path.join(folder, 'trainingstate.json')
 
 
-def train_model():
+def rows_digest(data_path, n_rows):
     """
-    Function for training the model
+    Digest of the hashes of the first rows of a dataset, from the row hashes saved by the ingestion next to it
+    :param data_path: csv path of the dataset
+    :param n_rows: number of rows
+    :return:
+    hex digest, None if there are no row hashes for these rows
     """
-    logger.info('training the model started.')
+    try:
+        hashes = np.load(os.path.join(os.path.dirname(data_path) or '.', 'rowhashes.npy'))
+    except FileNotFoundError:
+        return None
+    if len(hashes) < n_rows:
+        return None
+    return hashlib.blake2b(hashes[:n_rows].tobytes(), digest_size=16).hexdigest()
+
+
+def _make_model(C=1.0):
     # use this logistic regression for training
-    model = LogisticRegression(C=1.0, class_weight=None, dual=False, fit_intercept=True,
-                               intercept_scaling=1, l1_ratio=None, max_iter=100,
-                               multi_class='auto', n_jobs=None, penalty='l2',
-                               random_state=0, solver='liblinear', tol=0.0001, verbose=0,
-                               warm_start=False)
-
-    # fit the logistic regression to the data
-    X = pd.read_csv(dataset_csv_path).iloc[:, 1:]
-    y = X.pop('exited').values
+    return LogisticRegression(C=C, class_weight=None, dual=False, fit_intercept=True,
+                              intercept_scaling=1, l1_ratio=None, max_iter=100,
+                              multi_class='auto', n_jobs=None, penalty='l2',
+                              random_state=0, solver='liblinear', tol=0.0001, verbose=0,
+                              warm_start=False)
+
+
+def _full_fit(X, y):
+    model = _make_model()
     model.fit(X, y)
+    return model
 
-    # write the trained model to your workspace in a file called trainedmodel.pkl
-    logger.info(f'saving the model to {model_path}')
+
+def _augment(X):
+    # the intercept is the coefficient of a constant feature (intercept_scaling=1)
+    return np.hstack([X, np.ones((len(X), 1))])
+
+
+def _loss_terms(w, Xa, y):
+    """
+    Log-loss of rows for the coefficients w (intercept last), with its gradient and Hessian
+    """
+    z = Xa @ w
+    p = expit(z)
+    return np.sum(np.logaddexp(0, z) - y * z), Xa.T @ (p - y), (Xa.T * (p * (1 - p))) @ Xa
+
+
+def objective_derivatives(model, X, y):
+    """
+    Gradient and Hessian of the objective of a L2 logistic regression at its coefficients, C * sum of the log-loss
+    + 1/2 |w|^2, the intercept being penalized by liblinear only. The solver stops at a tolerance, so the gradient is
+    not exactly zero.
+    :param model: fitted LogisticRegression
+    :param X: features the model was fitted on
+    :param y: labels the model was fitted on
+    :return:
+    tuple (gradient, Hessian), the intercept last, (None, None) for another penalty
+    """
+    if getattr(model, 'penalty', None) != 'l2':
+        return None, None
+    w = np.append(model.coef_.ravel(), model.intercept_)
+    penalty = np.ones(len(w))
+    if model.solver != 'liblinear':
+        penalty[-1] = 0.0
+    _, grad, hess = _loss_terms(w, _augment(X), (y == model.classes_[-1]).astype(np.float64))
+    return model.C * grad + penalty * w, model.C * hess + np.diag(penalty)
+
+
+def _newton(w0, gradient0, hessian0, Xa, y, C, max_iter, tol=1e-10):
+    """
+    Minimize C * log-loss of the rows + gradient0^T (w - w0) + 1/2 (w - w0)^T hessian0 (w - w0) with Newton's method
+    and a backtracking line search
+    :return:
+    tuple (coefficients, gradient and Hessian of the objective at the coefficients, number of iterations), the Hessian
+    being None if the method didn't converge within max_iter iterations
+    """
+    def objective(w):
+        loss, grad, hess = _loss_terms(w, Xa, y)
+        diff = w - w0
+        return (C * loss + gradient0 @ diff + diff @ hessian0 @ diff / 2, C * grad + gradient0 + hessian0 @ diff,
+                C * hess + hessian0)
+
+    w = w0.copy()
+    value, grad, hess = objective(w)
+    for n_iter in range(max_iter + 1):
+        step = np.linalg.solve(hess, grad)
+        # Newton decrement: does not depend on the scale of the features
+        decrement = grad @ step
+        if decrement / 2 <= tol:
+            return w, grad, hess, n_iter
+        if n_iter == max_iter:
+            break
+        t = 1.0
+        while True:
+            candidate = w - t * step
+            new_value, new_grad, new_hess = objective(candidate)
+            if new_value <= value - t * decrement / 4 or t < 1e-10:
+                break
+            t /= 2
+        w, value, grad, hess = candidate, new_value, new_grad, new_hess
+    return w, grad, None, max_iter
+
+
+def _full_training(data_path, columns, mode, output_folder):
+    """
+    Fit the model on every row of the dataset
+    :return:
+    dictionary with the model, its schema, the gradient and Hessian of its objective, its drift reference, the number
+    of rows of the dataset and of rows fitted, and the results of the sweep in SWEEP mode
+    """
+    # the features and the target, selected by name, the features being recorded in the schema of the model
+    data = read_dataset(data_path, columns=columns)
+    schema = FeatureSchema.from_data(data)
+    # rows with a missing value are kept in the dataset (and counted by the missing data diagnostics) but not fitted
+    complete = complete_rows(data, schema.names + [target_column])
+    X, y = schema.matrix(data)[complete], target(data[complete])
+
+    sweep = None
+    if mode == SWEEP:
+        from sweep import run_sweep
+        model, sweep = run_sweep(X, y, output_folder)
+    else:
+        # fit the logistic regression to the data
+        model = _full_fit(X, y)
+    gradient, hessian = objective_derivatives(model, X, y)
+    # distribution of the training data and of the scores, reference of the drift monitoring
+    reference = DriftReference.from_data(schema.columns(X), model.predict_proba(X)[:, -1])
+    return {'model': model, 'schema': schema, 'gradient': gradient, 'hessian': hessian, 'reference': reference,
+            'n_rows': len(data), 'n_fitted': len(y), 'n_trained': len(y), 'sweep': sweep}
+
+
+def _incremental_fit(data_path, columns):
+    """
+    Update the deployed model with the rows ingested since it was trained, reading only these rows
+    :param data_path: csv path of the dataset
+    :param columns: columns of the dataset to load
+    :return:
+    tuple (dictionary with the same keys as the result of _full_training, None), or (None, reason) if the
+    incremental training can't be used
+    """
     try:
-        pickle.dump(model, open(model_path, 'wb'))
+        with open(deployed_path('trainingstate.json'), 'r') as f:
+            deployed_state = json.load(f)
     except FileNotFoundError:
-        os.mkdir(config['output_model_path'])
-        pickle.dump(model, open(model_path, 'wb'))
+        return None, 'the deployed model has no training state'
+    if deployed_state.get('hessian') is None or deployed_state.get('gradient') is None:
+        return None, 'the training state of the deployed model has no quadratic approximation'
+    if deployed_state.get('n_trained') is None:
+        return None, 'the training state of the deployed model has no number of rows trained on'
+    reference = deployed_reference()
+    if reference is None:
+        return None, 'the deployed model has no drift reference'
+    # imported here: only needed by the incremental training
+    from model_registry import get_model_schema
+    from evaluation import Evaluation, evaluate
+
+    deployed_model, schema = get_model_schema(prod_model_path())
+    if schema is None or schema.names != feature_names(columns):
+        return None, 'the features of the deployed model are different'
+    n_rows = deployed_state['n_rows']
+    if deployed_state['rows_digest'] is None or rows_digest(data_path, n_rows) != deployed_state['rows_digest']:
+        return None, 'the dataset has been rewritten since the deployed model was trained'
+    # the rows fitted by the deployed model are not read again
+    data = read_dataset(data_path, columns=columns, start=n_rows)
+    complete = complete_rows(data, schema.names + [target_column])
+    X, y = schema.matrix(data)[complete], target(data[complete])
+    if len(np.unique(y)) < 2:
+        return None, f'{len(y)} new row(s), with less than 2 classes'
+
+    max_iter = get_config()['incremental_max_iter']
+    C, classes = deployed_state['C'], np.asarray(deployed_model.classes_)
+    w0 = np.append(np.asarray(deployed_model.coef_, dtype=np.float64).ravel(), deployed_model.intercept_)
+    w, gradient, hessian, n_iter = _newton(w0, np.asarray(deployed_state['gradient']),
+                                           np.asarray(deployed_state['hessian']), _augment(X),
+                                           (y == classes[-1]).astype(np.float64), C, max_iter)
+    if hessian is None:
+        return None, f"Newton's method did not converge in {max_iter} iterations"
+    model = _make_model(C)
+    model.coef_, model.intercept_ = w[:-1].reshape(1, -1), w[-1:]
+    model.classes_, model.n_features_in_, model.n_iter_ = classes, X.shape[1], np.array([n_iter])
+
+    # the model must score as well as the deployed model on the test data
+    test_data = read_dataset(test_data_path(), columns=schema.names + [target_column])
+    X_test = schema.matrix(test_data)
+    f1 = Evaluation(target(test_data), model.predict(X_test), model.predict_proba(X_test)[:, -1]).f1
+    deployed_f1 = evaluate(test_data_path(), prod_model_path()).f1
+    if f1 < deployed_f1 - get_config()['score_drop_tolerance']:
+        return None, f'F1 score {f1:.4f} lower than the F1 score of the deployed model {deployed_f1:.4f}'
+
+    # the new rows are added to the drift reference of the deployed model
+    monitor = DriftMonitor(reference)
+    monitor.observe(data[complete], model.predict_proba(X)[:, -1])
+    return {'model': model, 'schema': schema, 'gradient': gradient, 'hessian': hessian,
+            'reference': reference.extended(monitor, deployed_state['n_trained']), 'n_rows': n_rows + len(data),
+            'n_fitted': len(y), 'n_trained': deployed_state['n_trained'] + len(y), 'sweep': None}, None
+
+
+def train_model(data_path=None, output_path=None, mode=None):
+    """
+    Function for training the model
+    :param data_path: path to the data used for training, default to output_folder_path/finaldata.csv
+    :param output_path: path where the model is saved, default to output_model_path/trainedmodel.pkl. The compact
+    export of the model (trainedmodel.npz), its feature schema (featureschema.json), its drift reference
+    (driftreference.json) and its training state (trainingstate.json) are saved in the same folder, with the results
+    of the sweep (sweepresults.json) in SWEEP mode.
+    :param mode: FULL, INCREMENTAL or SWEEP, default to training_mode in config.json
+    :return:
+    training state: dictionary with the mode used, the number of rows of the dataset, of rows fitted and of rows the
+    model has been trained on since its last full refit, the training time in seconds, the number of iterations of the
+    solver, the reason of a fallback to a full refit and, in SWEEP mode, the parameters chosen and their
+    cross-validated F1 score
+    """
+    logger.info('training the model started.')
+    starttime = timeit.default_timer()
+    data_path = data_path or dataset_csv_path()
+    output_path = output_path or model_path()
+    mode = mode or get_config()['training_mode']
+    output_folder = os.path.dirname(output_path) or '.'
+    os.makedirs(output_folder, exist_ok=True)
+    columns = labelled_columns(dataset_columns(data_path))
+
+    fitted, fallback = None, None
+    if mode == INCREMENTAL:
+        fitted, fallback = _incremental_fit(data_path, columns)
+        if fitted is None:
+            logger.info(f'incremental training not possible, {fallback}: full refit')
+    if fitted is None:
+        fitted = _full_training(data_path, columns, mode, output_folder)
+    model, schema, gradient, hessian = fitted['model'], fitted['schema'], fitted['gradient'], fitted['hessian']
+    training_time = timeit.default_timer() - starttime
+    state = {'mode': mode if mode in (INCREMENTAL, SWEEP) and fallback is None else FULL,
+             'n_rows': fitted['n_rows'], 'n_fitted': fitted['n_fitted'], 'n_trained': fitted['n_trained'],
+             'rows_digest': rows_digest(data_path, fitted['n_rows']),
+             'training_time': training_time, 'n_iter': int(np.max(model.n_iter_)), 'fallback': fallback,
+             # quadratic approximation of the objective, used by the next incremental training
+             'C': model.C, 'gradient': None if gradient is None else gradient.tolist(),
+             'hessian': None if hessian is None else hessian.tolist()}
+    if fitted['sweep'] is not None:
+        state.update(params=fitted['sweep']['best']['params'], cv_f1=fitted['sweep']['best']['f1'])
+    logger.info(f"{state['mode']} training on {state['n_fitted']} row(s) done in {training_time:.4f}s, "
+                f"{state['n_iter']} iteration(s)")
+
+    # write the trained model to your workspace in a file called trainedmodel.pkl
+    logger.info(f'saving the model to {output_path}')
+    # the schema is saved first, so that the model is never loaded without it
+    save_schema(schema, output_folder)
+    with open(output_path, 'wb') as f:
+        pickle.dump(model, f)
+    # compact export, loaded by the API without sklearn
+    export_model(model, schema.names, compact_path(output_path))
+    save_reference(fitted['reference'], output_folder)
+    with open(training_state_path(output_folder), 'w') as f:
+        json.dump(state, f, indent=2)
+    return state
 
 
 if __name__ == '__main__':
-    train_model()
+    args = sys.argv[1:]
+    print(json.dumps(train_model(mode=INCREMENTAL if '--incremental' in args else SWEEP if '--sweep' in args else None),
+                     indent=2))